@@ -1,15 +1,36 @@
 # agentic.py
 from __future__ import annotations
 import env_loader 
+import asyncio
 import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
 from typing import TypedDict, List, Dict, Any, Literal
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
-from langchain_openai import ChatOpenAI
+import numpy as np
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage, message_chunk_to_message
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 
 from tools.registry import TOOLS  # <-- decorated tools live here
-from tools.property_tools import list_frameworks as _derive_framework_names
+from tools.property_tools import list_frameworks as _derive_framework_names  # pure string formatting, no DB call
+
+try:
+    import orjson
+    _loads = orjson.loads  # 2-5x faster than json.loads on large tool outputs (list_docs, get_numbers)
+except ImportError:
+    _loads = json.loads
+
+logger = logging.getLogger(__name__)
 
 SYSTEM_PROMPT = """
 Eres **PropertyAgent** para RAMA Country Living. Tu objetivo es guiar al usuario hasta completar 3 plantillas por propiedad: **documentos**, **números** y **resumen de la propiedad**, trabajando siempre con herramientas.
@@ -23,6 +44,7 @@ Eres **PropertyAgent** para RAMA Country Living. Tu objetivo es guiar al usuario
 - NUNCA digas "no tengo acceso a conversaciones pasadas" - SÍ lo tienes.
 - Mantén coherencia con lo que el usuario te ha dicho en mensajes anteriores.
 - Cuando el usuario menciona que tiene documentos y luego pide resumirlos o consultarlos, USA LAS HERRAMIENTAS INMEDIATAMENTE para buscar y procesar esos documentos.
+- Antes de llamar a una herramienta, revisa las respuestas de herramientas (ToolMessage) anteriores en el historial. Extrae los datos de esas respuestas en lugar de repetir la misma llamada con los mismos parámetros; solo vuelve a llamar si el dato no está disponible o los parámetros son distintos.
 
 OBJETIVO GLOBAL (checklist de producto)
 1) Crear propiedades en Supabase. Cada nueva propiedad provisiona 3 plantillas: documentos, números, resumen.
@@ -42,6 +64,7 @@ PRINCIPIOS
 - Números (CRÍTICO): NUNCA inventes números, NUNCA rellenes celdas sin instrucción explícita o confirmación del usuario. Si faltan datos o hay dudas, dilo claramente y pide permiso antes de escribir.
 - Si no sabes un dato, dilo sin estimar ni suponer; ofrece el siguiente paso (p. ej., solicitar el valor o ejecutar un cálculo con parámetros explícitos).
 - Confirma cuando haya ambigüedad antes de escribir o enviar.
+- Cuando necesites información independiente (p. ej., `list_docs` + `get_numbers` + `list_frameworks`), emite TODAS las llamadas a herramientas en un solo mensaje para ejecutarlas en paralelo. No encadenes secuencialmente herramientas independientes; encadena solo cuando una llamada necesita el resultado de otra.
 - Español claro y conciso; muestra próximos pasos.
  - Resumen PowerPoint: prohibido inventar ubicaciones, fechas o fotos reales; usar solo fotos demo genéricas y placeholders donde falte información.
 
@@ -130,150 +153,854 @@ class AgentState(TypedDict):
     proposal: NotRequired[Dict[str, Any]]
     last_doc_ref: NotRequired[Dict[str, Any]]
     input: NotRequired[str]
+    tool_cache: NotRequired[Dict[str, Dict[str, Any]]]
+    # Rolling summary of the history that fell out of the verbatim window
+    history_summary: NotRequired[str]
+    summary_upto_idx: NotRequired[int]
+    # Bookkeeping so nodes only look at messages appended since their last run
+    _cursor: NotRequired[int]
+    _filtered_idx: NotRequired[List[int]]
+    _filtered_upto: NotRequired[int]
+    # Read-only outputs in the verbatim window: {"upto": summary_upto_idx, "seen": {digest: [tool_call_id, index]}}
+    _read_outputs: NotRequired[Dict[str, Any]]
 
 def prepare_input(state: AgentState):
     """Convert input text to HumanMessage if present."""
     if state.get("input"):
         # Return new messages to be added via add_messages reducer
-        return {"messages": [HumanMessage(content=state["input"])]}
+        return {"messages": [HumanMessage(content=state["input"])], "_cursor": len(state.get("messages", []))}
     # No input, no updates - return None or empty dict is fine for optional updates
     return None
 
 # --------------- Router ----------------
+# Whole-word matches: words that merely contain a keyword ("know", "nothing", "signo") no longer
+# trigger a branch. The stems cover inflected and accented forms ("confirmo", "confírmalo", "cancela",
+# "cancélalo", "cámbialo").
+_CONFIRM_RE = re.compile(r"\b(yes|conf[ií]rm\w*|ok|okay|go ahead|proceed|sí|si|vale|adelante|de acuerdo)\b", re.IGNORECASE)
+_CANCEL_RE = re.compile(r"\b(no|nope|canc[eé]l\w*|change|different|c[aá]mbi\w*|diferente)\b", re.IGNORECASE)
+_CANCEL_REPLY = "Vale, he cancelado la propuesta. ¿Qué prefieres hacer ahora?"
+_CONFIRMED_NOTE = "User confirmed. Proceed with the proposed action."
+
 def router_node(state: AgentState) -> Dict[str, Any]:
     """Check if we're awaiting confirmation and handle user's response."""
     updates = {}
     
     if state.get("awaiting_confirmation"):
         messages = state.get("messages", [])
-        # Look for the last user message to see if they confirmed
+        # Look for the last user message to see if they confirmed. prepare_input leaves
+        # `_cursor` on the message it just appended, so this is usually a direct lookup.
+        cursor = state.get("_cursor")
+        if cursor is not None and cursor < len(messages) and isinstance(messages[cursor], HumanMessage):
+            candidates = (messages[cursor],)
+        else:
+            candidates = reversed(messages)
         last_user = ""
-        for m in reversed(messages):
+        for m in candidates:
             if isinstance(m, HumanMessage):
-                content = m.content if isinstance(m.content, str) else str(m.content or "")
-                last_user = content.lower()
+                last_user = m.content if isinstance(m.content, str) else str(m.content or "")
                 break
         
         # Check for confirmation
-        if any(w in last_user for w in ("yes", "confirm", "ok", "go ahead", "sí", "si", "proceed")):
+        if _CONFIRM_RE.search(last_user):
             # User confirmed - clear the flag and let assistant proceed
             updates["awaiting_confirmation"] = False
-            updates["messages"] = [SystemMessage(content="User confirmed. Proceed with the proposed action.")]
-        elif any(w in last_user for w in ("no", "cancel", "change", "different", "nope")):
+            # The proposal is in the propose_doc_slot output in history; don't keep a second copy checkpointed
+            updates["proposal"] = {}
+            updates["messages"] = [SystemMessage(content=_CONFIRMED_NOTE)]
+        elif _CANCEL_RE.search(last_user):
             # User cancelled - clear the flag and proposal
             updates["awaiting_confirmation"] = False
             updates["proposal"] = {}
-            updates["messages"] = [SystemMessage(content="User cancelled. Ask what they'd like to do instead.")]
+            # Nothing left to plan: answer directly instead of spending an LLM call on it
+            updates["messages"] = [AIMessage(content=_CANCEL_REPLY, name="router")]
     
     return updates if updates else None
 
-# --------------- Assistant (planner) ---------------
-def assistant(state: AgentState) -> Dict[str, Any]:
+
+def entry_node(state: AgentState) -> Dict[str, Any] | None:
+    """prepare_input + router_node as one graph step, so a turn pays one checkpoint write
+    before the assistant instead of two."""
+    updates = prepare_input(state) or {}
+    if updates:
+        # The router has to see the HumanMessage this turn is adding
+        state = {**state, "messages": state.get("messages", []) + updates["messages"], "_cursor": updates["_cursor"]}
+        # Cached reads only live within a turn: app.py writes documents/numbers outside the graph
+        updates["tool_cache"] = {}
+    routed = router_node(state) or {}
+    if "messages" in routed and "messages" in updates:
+        routed["messages"] = updates["messages"] + routed["messages"]
+    return {**updates, **routed} or None
+
+
+def after_router(state: AgentState) -> Literal["summarize", "assistant", "end"]:
+    """End the turn when the router already answered (cancelled proposal). The summarize step
+    only runs when the history actually overflows, so normal turns skip its checkpoint write."""
     messages = state.get("messages", [])
-    llm = ChatOpenAI(model="gpt-4o", temperature=0).bind_tools(TOOLS)
-    
-    # Filtra mensajes inválidos y prepara contexto
-    filtered_msgs = []
-    for i, msg in enumerate(messages):
-        if isinstance(msg, ToolMessage):
-            if filtered_msgs and isinstance(filtered_msgs[-1], AIMessage) and getattr(filtered_msgs[-1], "tool_calls", None):
-                filtered_msgs.append(msg)
-        else:
-            filtered_msgs.append(msg)
+    if messages and isinstance(messages[-1], AIMessage) and messages[-1].name == "router":
+        return "end"
+    if _history_window(state, _filtered_indices(state)[0])[1]:
+        return "summarize"
+    return "assistant"
+
+# --------------- Assistant (planner) ---------------
+# The system prompt is sent as the first message, byte-identical on every turn, so
+# OpenAI's automatic prompt cache (prefixes >= 1024 tokens) can reuse it. Anything that
+# changes per turn goes after the conversation history.
+_SYSTEM_MSG = SystemMessage(content=SYSTEM_PROMPT)
+
 
-    # system + conversación + contexto de propiedad activa y último doc referenciado
-    msgs: List[Any] = [SystemMessage(content=SYSTEM_PROMPT)]
+def _turn_context(state: AgentState) -> str:
+    """Per-turn context (active property, last referenced document) appended after the history."""
+    parts = []
     if state.get("property_id"):
-        msgs.append(SystemMessage(content=f"Contexto: property_id activa = {state['property_id']}. Asume esta propiedad hasta que el usuario la cambie explícitamente."))
+        parts.append(f"Contexto: property_id activa = {state['property_id']}. Asume esta propiedad hasta que el usuario la cambie explícitamente.")
     if state.get("last_doc_ref"):
-        ldr = state["last_doc_ref"]
-        msgs.append(SystemMessage(content=f"Si el usuario dice 'ese documento', interpreta {ldr} como el objetivo por defecto."))
+        parts.append(f"Si el usuario dice 'ese documento', interpreta {state['last_doc_ref']} como el objetivo por defecto.")
+    return "\n".join(parts)
+
+
+@lru_cache(maxsize=256)
+def _context_message(text: str) -> SystemMessage:
+    """Per-turn context as a SystemMessage, reused while the active property/doc stay the same."""
+    return SystemMessage(content=text)
+
+
+def _log_prompt_cache(ai: Any) -> None:
+    """Log how many prompt tokens were served from OpenAI's prompt cache. Streamed replies only
+    carry `usage_metadata` (and the cached count only where langchain-openai reports it)."""
+    usage = (getattr(ai, "response_metadata", None) or {}).get("token_usage") or {}
+    if usage:
+        prompt, cached = usage.get("prompt_tokens"), (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    else:
+        meta = getattr(ai, "usage_metadata", None) or {}
+        prompt, cached = meta.get("input_tokens"), (meta.get("input_token_details") or {}).get("cache_read")
+    logger.debug("assistant prompt_tokens=%s cached_tokens=%s", prompt, cached)
+
+
+# Two tiers: short, simple requests and confirmed proposals go to the fast model; everything
+# else (multi-step planning, RAG answers) to the smart one.
+_SMART_MODEL = os.getenv("AGENT_MODEL", "gpt-4o")
+_FAST_MODEL = os.getenv("AGENT_FAST_MODEL", "gpt-4o-mini")
+_FAST_MAX_TOKENS = 20
+_SIMPLE_INTENT_RE = re.compile(r"\b(lista|listar|qué hay|que hay|abre|muestra|enséñame|list|show)\b", re.IGNORECASE)
+
+
+def _pick_model(msgs: List[Any]) -> str:
+    """Model for this call, based on the message that triggered it."""
+    last = msgs[-1] if msgs else None
+    if isinstance(last, SystemMessage) and last.content == _CONFIRMED_NOTE:
+        return _FAST_MODEL
+    if isinstance(last, HumanMessage) and isinstance(last.content, str):
+        if _count_tokens(last.content) < _FAST_MAX_TOKENS and _SIMPLE_INTENT_RE.search(last.content):
+            return _FAST_MODEL
+    return _SMART_MODEL
+
+
+@lru_cache(maxsize=8)
+def _get_llm(model: str = _SMART_MODEL, temperature: float = 0):
+    """ChatOpenAI bound to TOOLS, built once per (model, temperature) and reused across turns.
+    Reusing the instance keeps the tool schemas serialized once and the HTTP connection pool alive."""
+    return ChatOpenAI(model=model, temperature=temperature, timeout=60, max_retries=2).bind_tools(TOOLS)
+
+
+# --------------- LLM response cache ---------------
+# Two tiers in front of the planner LLM: an exact cache keyed on the whole prompt as sent
+# (summary, verbatim window, per-turn context), and an opt-in semantic cache
+# (AGENT_SEMANTIC_CACHE=1) matching the last user message by embedding, scoped to the
+# conversation thread, active property and rolling summary. Only plans that are safe to replay are stored: plain answers, or tool calls to
+# deterministic tools that don't read live Supabase state. The semantic tier additionally
+# skips prompts carrying tool outputs, since a paraphrase can't tell whether that data changed.
+_RESPONSE_CACHE_MAX = 512
+_RESPONSE_CACHE_TTL = int(os.getenv("AGENT_LLM_CACHE_TTL", "600"))
+_SEMANTIC_CACHE_ENABLED = os.getenv("AGENT_SEMANTIC_CACHE") == "1"
+_SEMANTIC_THRESHOLD = 0.97
+_CACHEABLE_TOOLS = frozenset({"list_frameworks", "propose_doc_slot"})
+
+# Exact entries remember their property, semantic scopes start with (thread_id, property_id),
+# so writes to a property can evict both tiers (invalidate_response_cache)
+_response_cache: "OrderedDict[str, tuple[float, AIMessage, str]]" = OrderedDict()
+_semantic_cache: Dict[tuple[str, ...], List[tuple[float, np.ndarray, AIMessage]]] = {}
+_embedding_memo: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _message_signature(m: Any) -> List[Any]:
+    content = m.content if isinstance(m.content, str) else json.dumps(m.content, sort_keys=True, default=str)
+    calls = [(tc.get("name"), tc.get("args")) for tc in (getattr(m, "tool_calls", None) or [])]
+    return [m.type, getattr(m, "name", None), content, calls]
+
+
+def _response_cache_key(state: AgentState, msgs: List[Any]) -> str:
+    payload = {
+        "awaiting_confirmation": bool(state.get("awaiting_confirmation")),
+        "context": _turn_context(state),
+        "summary": state.get("history_summary", "") if _summary_upto(state) else "",
+        # Every message the model sees, so an answer that leaned on an older turn only replays for the same history
+        "messages": [_message_signature(m) for m in msgs],
+    }
+    raw = SYSTEM_PROMPT + json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _is_cacheable(ai: Any) -> bool:
+    if not isinstance(ai, AIMessage) or getattr(ai, "invalid_tool_calls", None):
+        return False
+    calls = ai.tool_calls or []
+    if not calls and not ai.content:
+        return False
+    return all(tc.get("name") in _CACHEABLE_TOOLS for tc in calls)
+
+
+def _clone_ai(ai: AIMessage) -> AIMessage:
+    """Fresh copy of a cached answer: new message and tool-call ids so add_messages appends it."""
+    tool_calls = [{**tc, "id": f"call_{uuid.uuid4().hex[:24]}"} for tc in (ai.tool_calls or [])]
+    return AIMessage(content=ai.content, tool_calls=tool_calls)
+
+
+@lru_cache(maxsize=1)
+def _get_embeddings():
+    return OpenAIEmbeddings(model="text-embedding-3-small")
+
+
+def _unit(vec: List[float]) -> np.ndarray:
+    """Normalized float32 vector, so cosine similarity is a plain dot product."""
+    v = np.asarray(vec, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n else v
+
+
+def _memo_embedding(text: str) -> np.ndarray | None:
+    with _cache_lock:
+        vec = _embedding_memo.get(text)
+        if vec is not None:
+            _embedding_memo.move_to_end(text)
+        return vec
+
+
+def _remember_embedding(text: str, vec: List[float]) -> np.ndarray:
+    unit = _unit(vec)
+    with _cache_lock:
+        _embedding_memo[text] = unit
+        while len(_embedding_memo) > _RESPONSE_CACHE_MAX:
+            _embedding_memo.popitem(last=False)
+    return unit
+
+
+def _semantic_query(state: AgentState, msgs: List[Any], thread_id: str | None) -> tuple[tuple[str, ...], str] | None:
+    """(scope, text) for the semantic tier, only on fresh user turns of a known thread."""
+    if not _SEMANTIC_CACHE_ENABLED or not thread_id or not msgs or not isinstance(msgs[-1], HumanMessage):
+        return None
+    text = msgs[-1].content if isinstance(msgs[-1].content, str) else ""
+    if not text.strip():
+        return None
+    summary = state.get("history_summary", "") if _summary_upto(state) else ""
+    scope = (
+        thread_id,
+        state.get("property_id") or "-",
+        str(bool(state.get("awaiting_confirmation"))),
+        hashlib.sha256(summary.encode("utf-8")).hexdigest()[:16],
+    )
+    return scope, text.strip().lower()
+
+
+def _exact_cache_get(key: str) -> AIMessage | None:
+    now = time.time()
+    with _cache_lock:
+        hit = _response_cache.get(key)
+        if hit and now - hit[0] < _RESPONSE_CACHE_TTL:
+            _response_cache.move_to_end(key)
+            return _clone_ai(hit[1])
+        if hit:
+            del _response_cache[key]
+    return None
+
+
+def _semantic_cache_get(scope: tuple[str, ...], vec: np.ndarray) -> AIMessage | None:
+    now = time.time()
+    with _cache_lock:
+        entries = [e for e in _semantic_cache.get(scope, []) if now - e[0] < _RESPONSE_CACHE_TTL]
+        _semantic_cache[scope] = entries
+        if not entries:
+            return None
+        # One matrix-vector product over the scope instead of a Python loop per entry
+        sims = np.stack([e[1] for e in entries]) @ vec
+        best = int(sims.argmax())
+        if sims[best] >= _SEMANTIC_THRESHOLD:
+            return _clone_ai(entries[best][2])
+    return None
+
+
+def _response_cache_get(key: str, state: AgentState, msgs: List[Any], thread_id: str | None) -> tuple[AIMessage | None, np.ndarray | None]:
+    cached = _exact_cache_get(key)
+    if cached is not None:
+        return cached, None
+    query = _semantic_query(state, msgs, thread_id)
+    if not query:
+        return None, None
+    vec = _memo_embedding(query[1])
+    if vec is None:
+        try:
+            vec = _remember_embedding(query[1], _get_embeddings().embed_query(query[1]))
+        except Exception:
+            return None, None
+    return _semantic_cache_get(query[0], vec), vec
+
+
+async def _aresponse_cache_get(key: str, state: AgentState, msgs: List[Any], thread_id: str | None) -> tuple[AIMessage | None, np.ndarray | None]:
+    cached = _exact_cache_get(key)
+    if cached is not None:
+        return cached, None
+    query = _semantic_query(state, msgs, thread_id)
+    if not query:
+        return None, None
+    vec = _memo_embedding(query[1])
+    if vec is None:
+        try:
+            vec = _remember_embedding(query[1], await _get_embeddings().aembed_query(query[1]))
+        except Exception:
+            return None, None
+    return _semantic_cache_get(query[0], vec), vec
+
+
+def _response_cache_put(key: str, state: AgentState, msgs: List[Any], ai: Any, vec: np.ndarray | None, thread_id: str | None) -> None:
+    if not _is_cacheable(ai):
+        return
+    now = time.time()
+    with _cache_lock:
+        _response_cache[key] = (now, ai, state.get("property_id") or "-")
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > _RESPONSE_CACHE_MAX:
+            _response_cache.popitem(last=False)
+        query = _semantic_query(state, msgs, thread_id)
+        # An answer built on tool output (numbers, document lists) may be stale for a paraphrase
+        if vec is not None and query and not any(type(m) is ToolMessage for m in msgs):
+            entries = _semantic_cache.setdefault(query[0], [])
+            entries.append((now, vec, ai))
+            del entries[:-_RESPONSE_CACHE_MAX]
+
+
+def invalidate_response_cache(property_id: str) -> None:
+    """Forget cached answers for a property after its documents or numbers changed."""
+    with _cache_lock:
+        for key in [k for k, v in _response_cache.items() if v[2] == property_id]:
+            del _response_cache[key]
+        for scope in [s for s in _semantic_cache if s[1] == property_id]:
+            del _semantic_cache[scope]
+
+
+def clear_response_cache() -> None:
+    """Forget every cached answer (after purge_all_documents)."""
+    with _cache_lock:
+        _response_cache.clear()
+        _semantic_cache.clear()
+
+
+def _filtered_indices(state: AgentState) -> tuple[List[int], int]:
+    """Indices of messages safe to send to the LLM, extending the previous run's result.
+
+    A ToolMessage is kept only inside a tool block: right after an AIMessage with
+    tool_calls or after another kept ToolMessage (parallel calls produce several).
+    Only indices from `summary_upto_idx` on are kept (plus the last one, which the scan
+    continues from), so the checkpointed list stays as short as the verbatim window.
+    """
+    messages = state.get("messages", [])
+    idx = state.get("_filtered_idx") or []
+    upto = state.get("_filtered_upto", 0)
+    if upto > len(messages):
+        idx, upto = [], 0
+    summary_upto = _summary_upto(state)
+    if idx and idx[0] < summary_upto:
+        idx = idx[min(bisect_left(idx, summary_upto), len(idx) - 1):]
+    if upto == len(messages):
+        return idx, upto
+    idx = list(idx)
+    # Whether the last kept message opens/continues a tool block, tracked instead of re-inspected
+    prev = messages[idx[-1]] if idx else None
+    in_block = type(prev) is ToolMessage or (isinstance(prev, AIMessage) and bool(prev.tool_calls))
+    for i in range(upto, len(messages)):
+        msg = messages[i]
+        if type(msg) is ToolMessage:  # exact type: chunk classes never reach state
+            if in_block:
+                idx.append(i)
+        else:
+            idx.append(i)
+            in_block = isinstance(msg, AIMessage) and bool(msg.tool_calls)
+    return idx, len(messages)
+
+
+# --------------- History window + rolling summary ---------------
+# Only the last _HISTORY_WINDOW filtered messages (and at most _HISTORY_MAX_TOKENS) are sent
+# verbatim; older ones are folded into `history_summary` by a cheap model at the start of a
+# turn, or before an assistant step whose tool outputs pushed the window over budget. The
+# summary is extended in batches of _SUMMARY_BATCH messages (or down to half the token budget)
+# so the summarizer runs once every few turns. Nothing is dropped from the prompt without
+# being summarized first; if the summarizer fails, the window is sent whole.
+# Messages are never removed from the checkpoint.
+_HISTORY_WINDOW = 20
+_SUMMARY_BATCH = 10
+# Token budget for the verbatim history (large RAG/list outputs can blow past the message count)
+_HISTORY_MAX_TOKENS = int(os.getenv("AGENT_HISTORY_MAX_TOKENS", "6000"))
+_SUMMARY_PROMPT = (
+    "Resume la conversación entre un usuario y un asistente de gestión de propiedades inmobiliarias. "
+    "Conserva hechos concretos: ids y nombres de propiedades, documentos subidos o pendientes, números fijados, "
+    "decisiones tomadas y tareas en curso. Máximo 200 palabras, en el idioma del usuario."
+)
+
+
+@lru_cache(maxsize=1)
+def _get_summarizer():
+    return ChatOpenAI(model="gpt-4o-mini", temperature=0, timeout=30, max_retries=2)
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken  # installed with langchain-openai
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception:
+        return None
+
+
+# Token counts keyed by a digest of the text, so the memo never keeps large tool outputs alive
+_TOKEN_MEMO_MAX = 1024
+_token_memo: "OrderedDict[bytes, int]" = OrderedDict()
+_token_memo_lock = threading.Lock()
+
+
+def _count_tokens(text: str) -> int:
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    with _token_memo_lock:
+        n = _token_memo.get(key)
+        if n is not None:
+            _token_memo.move_to_end(key)
+            return n
+    enc = _get_encoding()
+    n = len(enc.encode(text, disallowed_special=())) if enc else len(text) // 4
+    with _token_memo_lock:
+        _token_memo[key] = n
+        while len(_token_memo) > _TOKEN_MEMO_MAX:
+            _token_memo.popitem(last=False)
+    return n
+
+
+def _message_tokens(m: Any) -> int:
+    content = m.content if isinstance(m.content, str) else json.dumps(m.content, default=str, ensure_ascii=False)
+    calls = getattr(m, "tool_calls", None)
+    return 4 + _count_tokens(content) + (_count_tokens(json.dumps(calls, default=str, ensure_ascii=False)) if calls else 0)
+
+
+def _trim_history(msgs: List[Any], max_tokens: int = _HISTORY_MAX_TOKENS) -> List[Any]:
+    """Drop the oldest messages until the history fits `max_tokens`. The current turn (from the
+    last HumanMessage on) is always kept whole, and the window never opens on an orphan ToolMessage."""
+    last_human = max((i for i, m in enumerate(msgs) if isinstance(m, HumanMessage)), default=0)
+    sizes = [_message_tokens(m) for m in msgs]
+    total = sum(sizes)
+    start = 0
+    while total > max_tokens and start < last_human:
+        total -= sizes[start]
+        start += 1
+    while start < last_human and isinstance(msgs[start], ToolMessage):
+        start += 1
+    return msgs[start:] if start else msgs
+
+
+def _summary_upto(state: AgentState) -> int:
+    upto = state.get("summary_upto_idx", 0)
+    return upto if upto <= len(state.get("messages", [])) else 0
+
+
+def _history_window(state: AgentState, idx: List[int]) -> tuple[int, List[Any]]:
+    """(new summary_upto_idx, messages to fold into the summary) once the verbatim tail
+    overflows by message count or by tokens."""
+    messages = state.get("messages", [])
+    covered = bisect_left(idx, _summary_upto(state))
+    tail = [messages[i] for i in idx[covered:]]
+    over_count = len(tail) > _HISTORY_WINDOW + _SUMMARY_BATCH
+    over_tokens = sum(_message_tokens(m) for m in tail) > _HISTORY_MAX_TOKENS
+    if not (over_count or over_tokens):
+        return 0, []
+    start = len(idx) - _HISTORY_WINDOW if over_count else covered
+    if over_tokens:
+        # Fold down to half the budget so the next few turns don't trigger it again
+        kept = tail[start - covered:]
+        start += len(kept) - len(_trim_history(kept, _HISTORY_MAX_TOKENS // 2))
+    # Never open the window on a ToolMessage whose AIMessage would be summarized away
+    while start < len(idx) - 1 and isinstance(messages[idx[start]], ToolMessage):
+        start += 1
+    if start <= covered:
+        return 0, []
+    return idx[start], [messages[i] for i in idx[covered:start]]
+
+
+def _summary_request(state: AgentState, delta: List[Any]) -> List[Any]:
+    previous = state.get("history_summary", "") if _summary_upto(state) else ""
+    lines = []
+    for m in delta:
+        content = m.content if isinstance(m.content, str) else json.dumps(m.content, default=str, ensure_ascii=False)
+        if isinstance(m, AIMessage) and m.tool_calls:
+            content = f"{content} [llama a {', '.join(tc['name'] for tc in m.tool_calls)}]".strip()
+        role = f"tool:{m.name}" if isinstance(m, ToolMessage) else m.type
+        lines.append(f"{role}: {content[:800]}")
+    body = (f"Resumen previo:\n{previous}\n\n" if previous else "") + "Mensajes nuevos:\n" + "\n".join(lines)
+    return [SystemMessage(content=_SUMMARY_PROMPT), HumanMessage(content=body)]
+
+
+def summarize_history(state: AgentState) -> Dict[str, Any] | None:
+    """Fold messages that left the verbatim window into `history_summary` (once per user turn)."""
+    upto, delta = _history_window(state, _filtered_indices(state)[0])
+    if not delta:
+        return None
+    try:
+        summary = _get_summarizer().invoke(_summary_request(state, delta)).content
+    except Exception as e:
+        # Summarizer unavailable: the assistant keeps sending the unsummarized part verbatim
+        logger.warning("history summary failed: %s", e)
+        return None
+    return {"history_summary": summary, "summary_upto_idx": upto}
+
+
+async def asummarize_history(state: AgentState) -> Dict[str, Any] | None:
+    upto, delta = _history_window(state, _filtered_indices(state)[0])
+    if not delta:
+        return None
+    try:
+        summary = (await _get_summarizer().ainvoke(_summary_request(state, delta))).content
+    except Exception as e:
+        logger.warning("history summary failed: %s", e)
+        return None
+    return {"history_summary": summary, "summary_upto_idx": upto}
+
+
+def _prompt_view(m: Any) -> Any:
+    """Message as sent to the planner: canned replies may carry a shorter `prompt_content`."""
+    compact = m.additional_kwargs.get("prompt_content") if isinstance(m, AIMessage) else None
+    return m.copy(update={"content": compact, "additional_kwargs": {}}) if compact else m
+
+
+_REPEATED_READ_NOTE = "(misma salida que la llamada anterior a {name}, {tool_call_id})"
+
+
+def _stub_repeated_reads(msgs: List[Any]) -> List[Any]:
+    """Send read-only outputs marked `prompt_same_as` (see `_mark_repeated_reads`) as a short note
+    while the earlier identical output is still in the prompt. The mark is set once, when the
+    message is appended, so earlier messages never change and the prompt prefix stays cacheable."""
+    sent = {m.tool_call_id for m in msgs if type(m) is ToolMessage}
+    out = list(msgs)
+    for i, m in enumerate(out):
+        same_as = m.additional_kwargs.get("prompt_same_as") if type(m) is ToolMessage else None
+        if same_as in sent:
+            out[i] = m.copy(update={"content": _REPEATED_READ_NOTE.format(name=m.name, tool_call_id=same_as),
+                                    "additional_kwargs": {}})
+    return out
+
+
+def _assistant_request(state: AgentState) -> tuple[List[Any], List[Any], Dict[str, Any]]:
+    """(prompt messages, verbatim history, bookkeeping updates) shared by the sync and async assistant."""
+    messages = state.get("messages", [])
+
+    # Filtra mensajes inválidos (solo revisa los nuevos desde el último turno)
+    idx, upto = _filtered_indices(state)
+    start = bisect_left(idx, _summary_upto(state))
+    filtered_msgs = _stub_repeated_reads([_prompt_view(messages[i]) for i in idx[start:]])
+
+    # system (prefijo fijo, cacheable) + resumen + conversación reciente + contexto por turno al final
+    msgs: List[Any] = [_SYSTEM_MSG]
+    if _summary_upto(state) and state.get("history_summary"):
+        msgs.append(SystemMessage(content=f"Resumen de la conversación anterior:\n{state['history_summary']}"))
     msgs += filtered_msgs
+    context = _turn_context(state)
+    if context:
+        msgs.append(_context_message(context))
+    return msgs, filtered_msgs, {"_filtered_idx": idx, "_filtered_upto": upto}
 
-    ai = llm.invoke(msgs)
-    return {"messages": [ai]}
+
+def _thread_id(config: RunnableConfig | None) -> str | None:
+    return ((config or {}).get("configurable") or {}).get("thread_id")
+
+
+def _cache_affinity(config: RunnableConfig | None) -> Dict[str, Any]:
+    """Route a conversation's requests to the same OpenAI prompt-cache shard: its prompt only
+    grows at the tail, so everything up to the previous turn is a cacheable prefix."""
+    thread_id = _thread_id(config)
+    return {"extra_body": {"prompt_cache_key": f"propagent:{thread_id}"}} if thread_id else {}
+
+
+def assistant(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+    # Tool outputs in this turn may have overflowed the window: summarize instead of dropping them
+    folded = summarize_history(state) or {}
+    state = {**state, **folded}
+    msgs, filtered_msgs, updates = _assistant_request(state)
+    updates.update(folded)
+
+    key = _response_cache_key(state, msgs)
+    cached, vec = _response_cache_get(key, state, filtered_msgs, _thread_id(config))
+    if cached is not None:
+        return {"messages": [cached], **updates}
+
+    ai = _get_llm(_pick_model(filtered_msgs)).invoke(msgs, **_cache_affinity(config))
+    _log_prompt_cache(ai)
+    _response_cache_put(key, state, filtered_msgs, ai, vec, _thread_id(config))
+    return {"messages": [ai], **updates}
+
+
+async def aassistant(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+    """Async twin of `assistant`, used when the graph runs through `ainvoke`/`astream`.
+    The completion is streamed so `stream_mode="messages"` callers get tokens as they arrive."""
+    folded = await asummarize_history(state) or {}
+    state = {**state, **folded}
+    msgs, filtered_msgs, updates = _assistant_request(state)
+    updates.update(folded)
+
+    key = _response_cache_key(state, msgs)
+    cached, vec = await _aresponse_cache_get(key, state, filtered_msgs, _thread_id(config))
+    if cached is not None:
+        return {"messages": [cached], **updates}
+
+    ai = None
+    async for chunk in _get_llm(_pick_model(filtered_msgs)).astream(msgs, config, stream_usage=True, **_cache_affinity(config)):
+        ai = chunk if ai is None else ai + chunk
+    ai = message_chunk_to_message(ai)
+    _log_prompt_cache(ai)
+    _response_cache_put(key, state, filtered_msgs, ai, vec, _thread_id(config))
+    return {"messages": [ai], **updates}
+
+# --------------- Tools (with short-lived read cache) ---------------
+# Read-only tool results are kept in state for a short TTL so identical calls in later
+# steps of the same turn are answered from the previous output instead of hitting Supabase
+# again. A write tool may change what those reads return, so it clears the cache (and evicts
+# cached answers for its property), and every new user turn starts with an empty one (entry_node).
+_WRITE_TOOLS = frozenset({
+    "add_property", "upload_and_link", "seed_mock_documents", "purge_property_documents", "purge_all_documents",
+    "set_number", "numbers_compute", "upsert_summary_value", "compute_summary",
+    "rag_index_document", "rag_index_all_documents",
+})
+# Neither writes nor repeatable reads: side effects outside the database, or one-off payloads
+# (files, audio) too large to keep in checkpointed state
+_UNCACHED_TOOLS = frozenset({
+    "send_email", "propose_doc_slot", "numbers_excel_export", "build_summary_ppt",
+    "transcribe_audio", "synthesize_speech", "process_voice_input", "create_voice_response",
+})
+_READ_ONLY_TOOLS = frozenset(t.name for t in TOOLS) - _WRITE_TOOLS - _UNCACHED_TOOLS
+_TOOL_CACHE_TTL = 60
+_COALESCE_INDEX_MIN = 3
+_tool_node = ToolNode(TOOLS)
+
+
+def _tool_cache_key(name: str, args: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps([name, args], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _split_tool_calls(state: AgentState) -> tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]], Dict[str, ToolMessage], List[Dict[str, Any]], Dict[str, str]]:
+    """(calls, live cache, cached results by call id, calls that still have to run,
+    duplicate call id -> id of the identical call that does run)."""
+    now = time.time()
+    calls = state["messages"][-1].tool_calls
+    cache = {k: v for k, v in (state.get("tool_cache") or {}).items() if now - v.get("ts", 0) < _TOOL_CACHE_TTL}
+
+    results: Dict[str, ToolMessage] = {}
+    misses = []
+    first: Dict[str, str] = {}
+    dupes: Dict[str, str] = {}
+    for tc in calls:
+        key = _tool_cache_key(tc["name"], tc["args"])
+        entry = cache.get(key) if tc["name"] in _READ_ONLY_TOOLS else None
+        if entry:
+            results[tc["id"]] = ToolMessage(content=entry["content"], name=tc["name"], tool_call_id=tc["id"])
+        elif key in first:
+            # Same tool with the same args twice in one message: run it once
+            dupes[tc["id"]] = first[key]
+        else:
+            first[key] = tc["id"]
+            misses.append(tc)
+    return calls, cache, results, _coalesce_index_calls(misses, dupes), dupes
+
+
+def _coalesce_index_calls(misses: List[Dict[str, Any]], dupes: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Replace _COALESCE_INDEX_MIN+ rag_index_document calls for one property with a single
+    rag_index_all_documents call (one list_docs + one pass) and answer each original call with its output."""
+    by_pid: Dict[str, List[Dict[str, Any]]] = {}
+    for tc in misses:
+        if tc["name"] == "rag_index_document" and tc["args"].get("property_id"):
+            by_pid.setdefault(tc["args"]["property_id"], []).append(tc)
+    for pid, group in by_pid.items():
+        if len(group) < _COALESCE_INDEX_MIN:
+            continue
+        batch = {"name": "rag_index_all_documents", "args": {"property_id": pid}, "id": f"{group[0]['id']}_all", "type": "tool_call"}
+        ids = {tc["id"] for tc in group}
+        misses = [tc for tc in misses if tc["id"] not in ids] + [batch]
+        for tc in group:
+            dupes[tc["id"]] = batch["id"]
+        for dup_id, orig_id in list(dupes.items()):
+            if orig_id in ids:
+                dupes[dup_id] = batch["id"]
+    return misses
+
+
+def _record_tool_results(calls: List[Dict[str, Any]], cache: Dict[str, Dict[str, Any]], misses: List[Dict[str, Any]], out: List[Any], results: Dict[str, ToolMessage], dupes: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+    now = time.time()
+    for m in out:
+        results[m.tool_call_id] = m
+    # Each answer keeps the name of the call it answers (a coalesced rag_index_document stays one)
+    names = {tc["id"]: tc["name"] for tc in calls}
+    for dup_id, orig_id in dupes.items():
+        m = results.get(orig_id)
+        if m is not None:
+            results[dup_id] = ToolMessage(content=m.content, name=names.get(dup_id, m.name), tool_call_id=dup_id, status=getattr(m, "status", "success"))
+    if any(tc["name"] in _WRITE_TOOLS for tc in misses):
+        cache = {}
+    for tc in misses:
+        m = results.get(tc["id"])
+        if tc["name"] in _READ_ONLY_TOOLS and m is not None and getattr(m, "status", "success") != "error":
+            cache[_tool_cache_key(tc["name"], tc["args"])] = {"ts": now, "content": m.content}
+    return cache
+
+
+def _mark_repeated_reads(state: AgentState, tool_messages: List[ToolMessage]) -> tuple[List[ToolMessage], Dict[str, Any]]:
+    """Tag new read-only outputs identical to an earlier call's output (same tool, args and
+    content) with `prompt_same_as`, so `_stub_repeated_reads` can shorten them in prompts.
+    Earlier outputs are remembered in `_read_outputs`, so only this step's messages are hashed."""
+    messages = state.get("messages", [])
+    upto = _summary_upto(state)
+    read_outputs = state.get("_read_outputs") or {}
+    seen = dict(read_outputs.get("seen") or {})
+    if read_outputs.get("upto", 0) != upto:
+        # Outputs folded into the summary are never sent again, so nothing can point at them
+        seen = {d: v for d, v in seen.items() if v[1] >= upto}
+    keys = {tc["id"]: _tool_cache_key(tc["name"], tc["args"]) for tc in (getattr(messages[-1], "tool_calls", None) or [])} if messages else {}
+    out = []
+    for i, m in enumerate(tool_messages, start=len(messages)):
+        key = keys.get(m.tool_call_id)
+        if m.name in _READ_ONLY_TOOLS and key is not None and getattr(m, "status", "success") != "error":
+            digest = hashlib.sha256(f"{key}:{m.content}".encode("utf-8")).hexdigest()[:32]
+            earlier = seen.setdefault(digest, [m.tool_call_id, i])[0]
+            if earlier != m.tool_call_id:
+                m = m.copy(update={"additional_kwargs": {**m.additional_kwargs, "prompt_same_as": earlier}})
+        out.append(m)
+    return out, {"upto": upto, "seen": seen}
+
+
+def _invalidate_written_properties(state: AgentState, misses: List[Dict[str, Any]]) -> None:
+    """Evict cached answers for every property a write tool in this step may have changed."""
+    for tc in misses:
+        if tc["name"] == "purge_all_documents":
+            clear_response_cache()
+        elif tc["name"] in _WRITE_TOOLS:
+            # No property to pin the write to (add_property before one is active): nothing cached to evict
+            pid = tc["args"].get("property_id") or state.get("property_id")
+            if pid:
+                invalidate_response_cache(pid)
+
+
+def tools_node(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+    """Run the last AIMessage's tool calls, serving read-only repeats from `tool_cache`."""
+    calls, cache, results, misses, dupes = _split_tool_calls(state)
+    if misses:
+        out = _tool_node.invoke({"messages": [AIMessage(content="", tool_calls=misses)]}, config)
+        cache = _record_tool_results(calls, cache, misses, out["messages"], results, dupes)
+        _invalidate_written_properties(state, misses)
+    return post_tool(state, [results[tc["id"]] for tc in calls if tc["id"] in results], cache)
+
+
+async def atools_node(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+    """Async twin of `tools_node`: ToolNode gathers the calls concurrently (sync tools run in
+    the default executor), so N independent Supabase calls take ~max latency instead of the sum."""
+    calls, cache, results, misses, dupes = _split_tool_calls(state)
+    if misses:
+        out = await _tool_node.ainvoke({"messages": [AIMessage(content="", tool_calls=misses)]}, config)
+        cache = _record_tool_results(calls, cache, misses, out["messages"], results, dupes)
+        _invalidate_written_properties(state, misses)
+    return post_tool(state, [results[tc["id"]] for tc in calls if tc["id"] in results], cache)
 
 # --------------- Post-tool hook --------------------
-# --------------- Post-tool hook --------------------
-def post_tool(state: AgentState) -> Dict[str, Any]:
-    """Interpret tool outputs and set flags for special workflows like document confirmation.
+def _on_propose_doc_slot(data: Any, updates: Dict[str, Any]) -> None:
+    updates["proposal"] = data
+    updates["awaiting_confirmation"] = True
+
+
+def _on_list_docs(rows: Any, updates: Dict[str, Any]) -> None:
+    # remember last referenced slot if list shows a single uploaded/missing item
+    if isinstance(rows, list) and len(rows) == 1:
+        r = rows[0]
+        updates["last_doc_ref"] = {
+            "document_group": r.get("document_group"),
+            "document_subgroup": r.get("document_subgroup"),
+            "document_name": r.get("document_name"),
+        }
+
+
+def _on_add_property(data: Any, updates: Dict[str, Any]) -> None:
+    pid = (data or {}).get("id")
+    if pid:
+        updates["property_id"] = pid
+        frameworks = _derive_framework_names(pid)
+        updates["messages"] = [
+            AIMessage(
+                content=(
+                    f"✅ Propiedad creada con id: {pid}\n"
+                    f"Frameworks: {frameworks}\n\n"
+                    "Hay tres frameworks vacíos que rellenar: documentos, números y resumen. "
+                    "¿Quieres empezar ahora (subir un documento, fijar un número, calcular el resumen) o prefieres más tarde?"
+                ),
+                # The schema names are for the user; later prompts only need the gist
+                additional_kwargs={"prompt_content": f"✅ Propiedad creada con id: {pid}. Frameworks vacíos: documentos, números y resumen."},
+            )
+        ]
+
+
+def _on_search_properties(hits: Any, updates: Dict[str, Any]) -> None:
+    if isinstance(hits, list) and len(hits) == 1 and hits[0].get("id"):
+        pid = hits[0]["id"]
+        updates["property_id"] = pid
+        updates["messages"] = [
+            AIMessage(content=(
+                f"Trabajaremos con la propiedad: {hits[0].get('name','(sin nombre)')} — {hits[0].get('address','')}\n"
+                f"Tienes 2 plantillas por completar: Documentos y Números. ¿Por dónde quieres empezar?"
+            ))
+        ]
+    elif isinstance(hits, list) and len(hits) > 1:
+        lines = "\n".join(f"{i}. {h.get('name','(sin nombre)')} — {h.get('address','')}" for i, h in enumerate(hits[:5], 1))
+        updates["messages"] = [
+            AIMessage(content=f"He encontrado estas propiedades:\n{lines}\n\nResponde con el número para continuar.")
+        ]
+
+
+_POST_TOOL_HANDLERS = {
+    "propose_doc_slot": _on_propose_doc_slot,
+    "list_docs": _on_list_docs,
+    "add_property": _on_add_property,
+    "search_properties": _on_search_properties,
+}
+
+
+def post_tool(state: AgentState, tool_messages: List[ToolMessage], tool_cache: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Tools-node update: the new ToolMessages, plus flags from interpreting them (document confirmation).
     Also captures add_property results to set property_id and inform about frameworks.
     Additionally, if `search_properties` returns un único candidato, fija `property_id` automáticamente; si devuelve varios,
     añade un mensaje para que el usuario elija.
+    Runs inside the tools step rather than as its own node, saving a checkpoint write per tool round.
     """
-    updates = {}
-    messages = state.get("messages", [])
-    
-    for msg in reversed(messages):
-        if isinstance(msg, ToolMessage):
-            if msg.name == "propose_doc_slot":
-                try:
-                    import json
-                    data = json.loads(msg.content) if isinstance(msg.content, str) else msg.content
-                    updates["proposal"] = data
-                    updates["awaiting_confirmation"] = True
-                except Exception:
-                    pass
-                break
-            if msg.name == "list_docs":
-                # remember last referenced slot if list shows a single uploaded/missing item
-                try:
-                    import json
-                    rows = json.loads(msg.content) if isinstance(msg.content, str) else msg.content
-                    if isinstance(rows, list) and len(rows) == 1:
-                        r = rows[0]
-                        updates["last_doc_ref"] = {
-                            "document_group": r.get("document_group"),
-                            "document_subgroup": r.get("document_subgroup"),
-                            "document_name": r.get("document_name"),
-                        }
-                except Exception:
-                    pass
-            if msg.name == "add_property":
-                try:
-                    import json
-                    data = json.loads(msg.content) if isinstance(msg.content, str) else msg.content
-                    pid = (data or {}).get("id")
-                    if pid:
-                        updates["property_id"] = pid
-                        frameworks = _derive_framework_names(pid)
-                        updates["messages"] = [
-                            AIMessage(
-                                content=(
-                                    f"✅ Propiedad creada con id: {pid}\n"
-                                    f"Frameworks: {frameworks}\n\n"
-                                    "Hay tres frameworks vacíos que rellenar: documentos, números y resumen. "
-                                    "¿Quieres empezar ahora (subir un documento, fijar un número, calcular el resumen) o prefieres más tarde?"
-                                )
-                            )
-                        ]
-                except Exception:
-                    pass
-                break
-            if msg.name == "search_properties":
-                try:
-                    import json
-                    hits = json.loads(msg.content) if isinstance(msg.content, str) else msg.content
-                    if isinstance(hits, list) and len(hits) == 1 and hits[0].get("id"):
-                        pid = hits[0]["id"]
-                        updates["property_id"] = pid
-                        frameworks = _derive_framework_names(pid)
-                        updates["messages"] = [
-                            AIMessage(content=(
-                                f"Trabajaremos con la propiedad: {hits[0].get('name','(sin nombre)')} — {hits[0].get('address','')}\n"
-                                f"Tienes 2 plantillas por completar: Documentos y Números. ¿Por dónde quieres empezar?"
-                            ))
-                        ]
-                    elif isinstance(hits, list) and len(hits) > 1:
-                        lines = [f"{i+1}. {h.get('name','(sin nombre)')} — {h.get('address','')}" for i, h in enumerate(hits[:5])]
-                        updates["messages"] = [
-                            AIMessage(content="He encontrado estas propiedades:\n" + "\n".join(lines) + "\n\nResponde con el número para continuar.")
-                        ]
-                except Exception:
-                    pass
-                break
-    
-    return updates if updates else None
+    updates: Dict[str, Any] = {"tool_cache": tool_cache}
+
+    for msg in reversed(tool_messages):
+        handler = _POST_TOOL_HANDLERS.get(msg.name) if isinstance(msg, ToolMessage) else None
+        if handler is None:
+            continue
+        try:
+            handler(_loads(msg.content) if isinstance(msg.content, (str, bytes)) else msg.content, updates)
+        except Exception:
+            pass
+        # list_docs only remembers the doc reference; the others settle the turn
+        if msg.name != "list_docs":
+            break
+
+    # A document reference from another property is stale once the active property changes
+    if updates.get("property_id") not in (None, state.get("property_id")) and "last_doc_ref" not in updates:
+        updates["last_doc_ref"] = None
+
+    # Canned replies from the handlers come after the tool outputs and end the turn
+    tool_messages, updates["_read_outputs"] = _mark_repeated_reads(state, tool_messages)
+    updates["messages"] = tool_messages + updates.get("messages", [])
+    return updates
 
 # --------------- Should we call a tool? ------------
 def should_call_tool(state: AgentState) -> Literal["tools", "end"]:
@@ -287,25 +1014,121 @@ def should_call_tool(state: AgentState) -> Literal["tools", "end"]:
 
 # --------------- Should we continue looping? ------------
 def should_continue(state: AgentState) -> Literal["assistant", "end"]:
-    """After executing tools, decide whether to call assistant again or end."""
+    """After executing tools, call the assistant again unless post_tool already answered."""
     messages = state.get("messages", [])
     if messages and isinstance(messages[-1], ToolMessage):
         return "assistant"
     return "end"
 
+# --------------- Checkpoint pruning -----------------------
+# Every graph step writes a checkpoint, so a thread accumulates dozens per turn while only the
+# latest one is read back. A daemon thread keeps the newest CHECKPOINT_KEEP_LAST per thread
+# (0 disables pruning) every CHECKPOINT_PRUNE_INTERVAL seconds. The latest checkpoint holds the
+# full message list, so conversation memory is unaffected.
+_CHECKPOINT_KEEP_LAST = int(os.getenv("CHECKPOINT_KEEP_LAST", "20"))
+_CHECKPOINT_PRUNE_INTERVAL = int(os.getenv("CHECKPOINT_PRUNE_INTERVAL", "3600"))
+
+# Pruning goes thread by thread: find the threads over the limit, then delete everything older
+# than each one's keep-th newest checkpoint in its own short transaction, so no statement has to
+# scan or lock the whole table.
+_PRUNE_SELECT_POSTGRES = (
+    """SELECT thread_id, checkpoint_ns FROM checkpoints
+       GROUP BY thread_id, checkpoint_ns HAVING count(*) > %(keep)s""",
+    """SELECT checkpoint_id FROM checkpoints WHERE thread_id = %(thread_id)s AND checkpoint_ns = %(checkpoint_ns)s
+       ORDER BY checkpoint_id DESC LIMIT 1 OFFSET %(offset)s""",
+)
+_PRUNE_SQL_POSTGRES = (
+    """DELETE FROM checkpoints WHERE thread_id = %(thread_id)s AND checkpoint_ns = %(checkpoint_ns)s
+         AND checkpoint_id < %(cutoff)s""",
+    """DELETE FROM checkpoint_writes WHERE thread_id = %(thread_id)s AND checkpoint_ns = %(checkpoint_ns)s
+         AND checkpoint_id < %(cutoff)s""",
+    """DELETE FROM checkpoint_blobs b WHERE b.thread_id = %(thread_id)s AND b.checkpoint_ns = %(checkpoint_ns)s
+         AND NOT EXISTS (
+           SELECT 1 FROM checkpoints c WHERE c.thread_id = b.thread_id AND c.checkpoint_ns = b.checkpoint_ns
+             AND c.checkpoint -> 'channel_versions' ->> b.channel = b.version)""",
+)
+_PRUNE_SELECT_SQLITE = (
+    """SELECT thread_id, checkpoint_ns FROM checkpoints
+       GROUP BY thread_id, checkpoint_ns HAVING count(*) > :keep""",
+    """SELECT checkpoint_id FROM checkpoints WHERE thread_id = :thread_id AND checkpoint_ns = :checkpoint_ns
+       ORDER BY checkpoint_id DESC LIMIT 1 OFFSET :offset""",
+)
+_PRUNE_SQL_SQLITE = (
+    """DELETE FROM checkpoints WHERE thread_id = :thread_id AND checkpoint_ns = :checkpoint_ns
+         AND checkpoint_id < :cutoff""",
+    """DELETE FROM writes WHERE thread_id = :thread_id AND checkpoint_ns = :checkpoint_ns
+         AND checkpoint_id < :cutoff""",
+)
+_pruner_lock = threading.Lock()
+_pruner_started = False
+
+
+def _prune_threads(conn: Any, select: tuple[str, str], deletes: tuple[str, ...], keep: int, transaction: Any) -> None:
+    for thread_id, checkpoint_ns in conn.execute(select[0], {"keep": keep}).fetchall():
+        params = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "offset": keep - 1}
+        row = conn.execute(select[1], params).fetchone()
+        if row is None:
+            continue
+        params["cutoff"] = row[0]
+        with transaction():
+            for sql in deletes:
+                conn.execute(sql, params)
+
+
+def prune_checkpoints(database_url: str | None = None, keep: int = _CHECKPOINT_KEEP_LAST) -> None:
+    """Delete all but the newest `keep` checkpoints of every thread (Postgres if a URL is given, else SQLite)."""
+    if keep <= 0:
+        return
+    if database_url:
+        import psycopg
+        with psycopg.connect(database_url, autocommit=True) as conn:
+            _prune_threads(conn, _PRUNE_SELECT_POSTGRES, _PRUNE_SQL_POSTGRES, keep, conn.transaction)
+    else:
+        from sqlite3 import connect
+        conn = connect(_sqlite_path(), timeout=30)
+        try:
+            # The connection itself is the transaction context: commit on success, roll back on error
+            _prune_threads(conn, _PRUNE_SELECT_SQLITE, _PRUNE_SQL_SQLITE, keep, lambda: conn)
+        finally:
+            conn.close()
+
+
+def _start_checkpoint_pruner(database_url: str | None) -> None:
+    global _pruner_started
+    with _pruner_lock:
+        if _pruner_started or _CHECKPOINT_KEEP_LAST <= 0:
+            return
+        _pruner_started = True
+
+    def _loop():
+        while True:
+            try:
+                prune_checkpoints(database_url)
+            except Exception as e:
+                logger.warning("checkpoint pruning failed: %s", e)
+            time.sleep(_CHECKPOINT_PRUNE_INTERVAL)
+
+    threading.Thread(target=_loop, name="checkpoint-pruner", daemon=True).start()
+
+
 # --------------- Build graph -----------------------
-def build_graph():
+def _make_graph() -> StateGraph:
     graph = StateGraph(AgentState)
-    graph.add_node("prepare_input", prepare_input)
-    graph.add_node("router", router_node)
-    graph.add_node("assistant", assistant)
-    graph.add_node("tools", ToolNode(TOOLS))
-    graph.add_node("post_tool", post_tool)
-
-    # Entry point: prepare user input then check for confirmations
-    graph.set_entry_point("prepare_input")
-    graph.add_edge("prepare_input", "router")
-    graph.add_edge("router", "assistant")
+    # Input handling and confirmation routing share one step; post_tool runs inside "tools"
+    graph.add_node("entry", entry_node)
+    graph.add_node("summarize", RunnableLambda(summarize_history, afunc=asummarize_history, name="summarize"))
+    # Sync + async implementations: `invoke` (Gradio) uses the first, `ainvoke` (FastAPI) the second
+    graph.add_node("assistant", RunnableLambda(assistant, afunc=aassistant, name="assistant"))
+    graph.add_node("tools", RunnableLambda(tools_node, afunc=atools_node, name="tools"))
+
+    # Entry point: prepare user input and check for confirmations
+    graph.set_entry_point("entry")
+    graph.add_conditional_edges(
+        "entry",
+        after_router,
+        {"summarize": "summarize", "assistant": "assistant", "end": END},
+    )
+    graph.add_edge("summarize", "assistant")
     
     # After assistant: either call tools or end
     graph.add_conditional_edges(
@@ -314,28 +1137,54 @@ def build_graph():
         {"tools": "tools", "end": END},
     )
     
-    # After tools: run post_tool hook
-    graph.add_edge("tools", "post_tool")
-    
-    # After post_tool: loop back to assistant to see results and continue or end
+    # After tools (and the post_tool hook): loop back to assistant to see results, or end
     graph.add_conditional_edges(
-        "post_tool",
+        "tools",
         should_continue,
         {"assistant": "assistant", "end": END}
     )
+    return graph
+
+
+# Postgres pool bounds. Every node step reads and writes a checkpoint, so concurrent sessions
+# queue on the pool long before OpenAI is the bottleneck; the async pool holds connections only
+# for the query itself and can run much wider than the sync one.
+_POOL_MIN_SIZE = int(os.getenv("CHECKPOINT_POOL_MIN", "2"))
+_POOL_MAX_SIZE = int(os.getenv("CHECKPOINT_POOL_MAX", "10"))
+_APOOL_MAX_SIZE = int(os.getenv("CHECKPOINT_APOOL_MAX", "32"))
+
+
+def _sqlite_path() -> str:
+    return os.path.join(os.path.dirname(__file__), "checkpoints.db")
+
+
+# setup() already switches the file to WAL; in WAL mode synchronous=NORMAL is still crash-safe
+# and skips an fsync per checkpoint commit
+_SQLITE_PRAGMAS = ("PRAGMA synchronous=NORMAL", "PRAGMA temp_store=MEMORY", "PRAGMA mmap_size=268435456")
+
+
+def _sqlite_saver():
+    from langgraph.checkpoint.sqlite import SqliteSaver
+    from sqlite3 import connect
+    db_path = _sqlite_path()
+    conn = connect(db_path, check_same_thread=False)
+    for pragma in _SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    checkpointer = SqliteSaver(conn)
+    checkpointer.setup()
+    print(f"✅ SQLite checkpointer active: {db_path}")
+    return checkpointer
+
+
+def build_graph():
+    graph = _make_graph()
 
     # Compile with PostgreSQL checkpointer for persistent memory
     database_url = os.getenv("DATABASE_URL")
     
     if not database_url:
         print("⚠️  WARNING: DATABASE_URL not found! Using SQLite fallback...")
-        from langgraph.checkpoint.sqlite import SqliteSaver
-        from sqlite3 import connect
-        db_path = os.path.join(os.path.dirname(__file__), "checkpoints.db")
-        conn = connect(db_path, check_same_thread=False)
-        checkpointer = SqliteSaver(conn)
-        checkpointer.setup()
-        print(f"✅ SQLite checkpointer active: {db_path}")
+        checkpointer = _sqlite_saver()
     else:
         print(f"🔄 Connecting to PostgreSQL (Supabase)...")
         print(f"   Host: {database_url.split('@')[1].split('/')[0] if '@' in database_url else 'configured'}")
@@ -347,8 +1196,8 @@ def build_graph():
             # Create a connection pool for PostgresSaver
             pool = ConnectionPool(
                 conninfo=database_url,
-                min_size=1,
-                max_size=10,
+                min_size=_POOL_MIN_SIZE,
+                max_size=_POOL_MAX_SIZE,
                 timeout=30,
                 max_idle=300,
                 max_lifetime=3600,
@@ -364,19 +1213,113 @@ def build_graph():
         except Exception as e:
             print(f"❌ PostgreSQL connection failed: {e}")
             print(f"⚠️  Falling back to SQLite...")
-            from langgraph.checkpoint.sqlite import SqliteSaver
-            from sqlite3 import connect
-            db_path = os.path.join(os.path.dirname(__file__), "checkpoints.db")
-            conn = connect(db_path, check_same_thread=False)
-            checkpointer = SqliteSaver(conn)
-            checkpointer.setup()
-            print(f"✅ SQLite checkpointer active: {db_path}")
+            checkpointer = _sqlite_saver()
     
+    return _compile(graph, checkpointer, database_url)
+
+
+async def abuild_graph():
+    """Same graph as `build_graph`, compiled with an async checkpointer so it can be driven
+    with `ainvoke`/`astream` from the event loop (the sync savers don't implement the async API).
+    Must be awaited inside the running loop, e.g. on FastAPI startup."""
+    graph = _make_graph()
+    database_url = os.getenv("DATABASE_URL")
+    checkpointer = None
+
+    if not database_url:
+        print("⚠️  WARNING: DATABASE_URL not found! Using SQLite fallback...")
+    else:
+        print(f"🔄 Connecting to PostgreSQL (Supabase, async)...")
+        try:
+            from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+            from psycopg_pool import AsyncConnectionPool
+
+            pool = AsyncConnectionPool(
+                conninfo=database_url,
+                min_size=_POOL_MIN_SIZE,
+                max_size=_APOOL_MAX_SIZE,
+                timeout=30,
+                max_idle=300,
+                max_lifetime=3600,
+                open=False,
+            )
+            await pool.open()
+            checkpointer = AsyncPostgresSaver(pool)
+            await checkpointer.setup()
+            print(f"✅ PostgreSQL connected with async connection pool!")
+        except Exception as e:
+            print(f"❌ PostgreSQL connection failed: {e}")
+            print(f"⚠️  Falling back to SQLite...")
+            checkpointer = None
+
+    if checkpointer is None:
+        import aiosqlite
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+        db_path = _sqlite_path()
+        conn = await aiosqlite.connect(db_path)
+        for pragma in _SQLITE_PRAGMAS:
+            await conn.execute(pragma)
+        checkpointer = AsyncSqliteSaver(conn)
+        await checkpointer.setup()
+        print(f"✅ SQLite checkpointer active: {db_path}")
+
+    return _compile(graph, checkpointer, database_url)
+
+
+def _compile(graph: StateGraph, checkpointer: Any, database_url: str | None):
+    _start_checkpoint_pruner(database_url if "Postgres" in type(checkpointer).__name__ else None)
     app = graph.compile(checkpointer=checkpointer)
 
-    # Skip ASCII graph drawing to avoid potential hangs
-    # try:
-    #     print(app.get_graph().draw_ascii())
-    # except Exception:
-    #     pass
+    # ASCII graph drawing walks the whole graph (and has hung before): debug only
+    if os.getenv("LANGGRAPH_DEBUG"):
+        try:
+            print(app.get_graph().draw_ascii())
+        except Exception:
+            pass
     return app
+
+
+# --------------- Shared compiled app -----------------------
+# Compiling the graph and opening the checkpointer pool is done once per process;
+# callers should use get_app() / aget_app() instead of calling the builders directly.
+_app = None
+_aapp = None
+_app_lock = threading.Lock()
+_aapp_lock = asyncio.Lock()
+
+
+def get_app():
+    """Graph compiled with the sync checkpointer (`invoke`/`stream`), built on first use."""
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                _app = build_graph()
+    return _app
+
+
+async def aget_app():
+    """Graph compiled with the async checkpointer (`ainvoke`/`astream`), built on first use."""
+    global _aapp
+    if _aapp is None:
+        async with _aapp_lock:
+            if _aapp is None:
+                _aapp = await abuild_graph()
+    return _aapp
+
+
+_BATCH_MAX_CONCURRENCY = int(os.getenv("AGENT_BATCH_CONCURRENCY", "16"))
+
+
+def run_batch(inputs: List[Dict[str, Any]], configs: List[Dict[str, Any]], max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+              return_exceptions: bool = False) -> List[Any]:
+    """Run independent conversations (one thread_id per config) concurrently on the sync graph."""
+    configs = [{**c, "max_concurrency": max_concurrency} for c in configs]
+    return get_app().batch(inputs, configs, return_exceptions=return_exceptions)
+
+
+async def arun_batch(inputs: List[Dict[str, Any]], configs: List[Dict[str, Any]], max_concurrency: int = _BATCH_MAX_CONCURRENCY,
+                     return_exceptions: bool = False) -> List[Any]:
+    """Async twin of `run_batch`: at most `max_concurrency` turns in flight against OpenAI at once."""
+    configs = [{**c, "max_concurrency": max_concurrency} for c in configs]
+    return await (await aget_app()).abatch(inputs, configs, return_exceptions=return_exceptions)
@@ -1,11 +1,19 @@
 from __future__ import annotations
 import env_loader  # loads .env first
-import base64, os, uuid, re, unicodedata, json
+import asyncio, base64, logging, os, uuid, re, unicodedata, json, time
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Dict, Any
+from urllib.parse import quote, unquote
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 from fastapi import FastAPI, UploadFile, Form, File
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from agentic import build_graph
+from agentic import aget_app, clear_response_cache, invalidate_response_cache
+from langchain_core.messages import AIMessage
 from tools.property_tools import list_frameworks, list_properties as db_list_properties, add_property as db_add_property
 from tools.property_tools import search_properties as db_search_properties
 from tools.docs_tools import propose_slot, upload_and_link, list_docs, slot_exists, seed_mock_documents
@@ -27,36 +35,205 @@ from tools.numbers_agent import (
     chart_sensitivity_heatmap as numbers_chart_sensitivity,
 )
 
-agent = build_graph()
+logger = logging.getLogger(__name__)
+# Per-request tracing is logged at DEBUG; RAMA_DEBUG=1 turns it on
+if os.getenv("RAMA_DEBUG") == "1":
+    logging.basicConfig(level=logging.INFO)
+    logger.setLevel(logging.DEBUG)
+
+# Session state management (persistent to survive reloads).
+# One JSON file per session under SESSIONS_DIR, so a turn only rewrites its own session.
+SESSIONS_DIR = ".sessions"
+LEGACY_SESSIONS_FILE = ".sessions.json"
+_SESSIONS_LOCK_FILE = os.path.join(SESSIONS_DIR, ".lock")
+_SESSIONS_LOCK_TIMEOUT = 10.0
+# Write a session every N save_sessions() calls; force=True always writes
+_AUTO_SAVE_INTERVAL = max(1, int(os.getenv("SESSIONS_AUTO_SAVE_INTERVAL", "1")))
+_UNSAVED: Dict[str, int] = {}
+
+
+def _session_path(session_id: str) -> str:
+    # Quote the id so a client-supplied session_id can never escape SESSIONS_DIR
+    return os.path.join(SESSIONS_DIR, quote(session_id, safe="") + ".json")
+
+
+@contextmanager
+def _sessions_lock():
+    """Exclusive cross-process lock on SESSIONS_DIR (no-op where fcntl is unavailable)."""
+    with open(_SESSIONS_LOCK_FILE, "a") as fd:
+        if fcntl is not None:
+            deadline = time.monotonic() + _SESSIONS_LOCK_TIMEOUT
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"Could not lock {_SESSIONS_LOCK_FILE}")
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
 
-# Session state management (persistent to survive reloads)
-SESSIONS_FILE = ".sessions.json"
 
 def load_sessions():
-    """Load sessions from file."""
-    if os.path.exists(SESSIONS_FILE):
+    """Load sessions from SESSIONS_DIR (and the old single-file store, if still around)."""
+    sessions = {}
+    if os.path.exists(LEGACY_SESSIONS_FILE):
         try:
-            with open(SESSIONS_FILE, 'r') as f:
-                return json.load(f)
+            with open(LEGACY_SESSIONS_FILE, 'r') as f:
+                sessions.update(json.load(f))
         except:
-            return {}
-    return {}
+            pass
+    if os.path.isdir(SESSIONS_DIR):
+        for name in os.listdir(SESSIONS_DIR):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(SESSIONS_DIR, name), 'r') as f:
+                    sessions[unquote(name[:-5])] = json.load(f)
+            except:
+                continue
+    return sessions
 
-def save_sessions():
-    """Save sessions to file."""
+
+def _write_session(session_id: str, payload: str):
+    """Write one serialized session to a temp file and atomically os.replace() it into place."""
     try:
-        print(f"[DEBUG] Saving sessions to {SESSIONS_FILE}: {len(SESSIONS)} sessions")
-        with open(SESSIONS_FILE, 'w') as f:
-            json.dump(SESSIONS, f, indent=2)
-        print(f"[DEBUG] Sessions saved successfully")
-    except Exception as e:
-        print(f"[ERROR] Could not save sessions: {e}")
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        path = _session_path(session_id)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with _sessions_lock():
+            with open(tmp, 'w') as f:
+                f.write(payload)
+            os.replace(tmp, path)
+        logger.debug("Session %s saved to %s", session_id, path)
+    except Exception:
+        logger.exception("Could not save session %s", session_id)
+
+
+def _snapshot_session(session_id: str) -> str | None:
+    # Serialized on the caller's thread so the dict is never read while a request mutates it.
+    # A session that can't be serialized is logged and skipped, never raised into the caller.
+    _UNSAVED.pop(session_id, None)
+    try:
+        return json.dumps(SESSIONS[session_id], ensure_ascii=False)
+    except Exception:
+        logger.exception("Could not serialize session %s", session_id)
+        return None
+
+
+def _save_session_now(session_id: str):
+    payload = _snapshot_session(session_id)
+    if payload is not None:
+        _write_session(session_id, payload)
+
+
+# Inside the server, saves are queued and written by _flush_sessions_loop; elsewhere they're immediate
+_dirty_sessions: asyncio.Queue | None = None
+_flush_task: asyncio.Task | None = None
+_FLUSH_DEBOUNCE = 0.5
+
+
+def save_sessions(session_id: str, force: bool = False):
+    """Persist one session. force=True writes right away instead of waiting for the flush loop."""
+    _UNSAVED[session_id] = _UNSAVED.get(session_id, 0) + 1
+    if not force and _UNSAVED[session_id] < _AUTO_SAVE_INTERVAL:
+        return
+    if force or _dirty_sessions is None:
+        _save_session_now(session_id)
+    else:
+        _dirty_sessions.put_nowait(session_id)
+
+
+async def asave_sessions(session_id: str):
+    """save_sessions(force=True) for request handlers: the file lock and write run in a worker thread."""
+    payload = _snapshot_session(session_id)
+    if payload is not None:
+        await asyncio.to_thread(_write_session, session_id, payload)
+
+
+async def _flush_sessions_loop():
+    """Coalesce queued saves: at most one write per session every _FLUSH_DEBOUNCE seconds."""
+    while True:
+        pending = {await _dirty_sessions.get()}
+        await asyncio.sleep(_FLUSH_DEBOUNCE)
+        while not _dirty_sessions.empty():
+            pending.add(_dirty_sessions.get_nowait())
+        for sid in pending:
+            payload = _snapshot_session(sid) if sid in SESSIONS else None
+            if payload is not None:
+                await asyncio.to_thread(_write_session, sid, payload)
+
+
+def flush_sessions():
+    """Write every session with queued or batched changes."""
+    pending = set(_UNSAVED)
+    while _dirty_sessions is not None and not _dirty_sessions.empty():
+        pending.add(_dirty_sessions.get_nowait())
+    for sid in pending:
+        if sid in SESSIONS:
+            _save_session_now(sid)
 
 SESSIONS = load_sessions()
 
+# Uploaded files awaiting confirmation are parked on disk; the session only keeps the path
+_PENDING_DIR = os.path.join(SESSIONS_DIR, "pending")
+# Blobs whose proposal was never confirmed or cancelled are swept on startup after this long
+_PENDING_MAX_AGE_HOURS = float(os.getenv("SESSIONS_PENDING_MAX_AGE_HOURS", "24"))
+
+
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+async def _spool_upload(upload: UploadFile) -> str:
+    """Copy an uploaded file to a pending blob in fixed-size chunks, never holding it whole."""
+    os.makedirs(_PENDING_DIR, exist_ok=True)
+    blob_path = os.path.join(_PENDING_DIR, f"{uuid.uuid4().hex}.bin")
+    try:
+        with open(blob_path, "wb") as out:
+            while chunk := await upload.read(_UPLOAD_CHUNK_SIZE):
+                out.write(chunk)
+    except BaseException:
+        if os.path.exists(blob_path):
+            os.unlink(blob_path)
+        raise
+    return blob_path
+
+
+def _clear_pending_proposal(STATE: Dict[str, Any]):
+    """Drop the pending proposal and delete its parked file, if any."""
+    pending = STATE.get("pending_proposal") or {}
+    if pending.get("blob_path"):
+        try:
+            os.unlink(pending["blob_path"])
+        except OSError:
+            pass
+    STATE["pending_proposal"] = None
+
+
+def _sweep_pending_blobs(max_age_hours: float = _PENDING_MAX_AGE_HOURS) -> int:
+    """Delete pending blobs older than max_age_hours; a later confirm just asks for the file again."""
+    if not os.path.isdir(_PENDING_DIR):
+        return 0
+    cutoff = time.time() - max_age_hours * 3600
+    removed = 0
+    for entry in os.scandir(_PENDING_DIR):
+        try:
+            if entry.name.endswith(".bin") and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        logger.info("Removed %d abandoned pending upload(s) from %s", removed, _PENDING_DIR)
+    return removed
+
 def get_session(session_id: str):
     if session_id not in SESSIONS:
-        print(f"[DEBUG] Creating NEW session: {session_id}")
+        logger.debug("Creating NEW session: %s", session_id)
         SESSIONS[session_id] = {
             "property_id": None,
             "pending_proposal": None,
@@ -79,7 +256,7 @@ def get_session(session_id: str):
             "last_doc_ref": None,
         }
     else:
-        print(f"[DEBUG] Using EXISTING session: {session_id}, current property_id: {SESSIONS[session_id].get('property_id')}")
+        logger.debug("Using EXISTING session: %s, current property_id: %s", session_id, SESSIONS[session_id].get('property_id'))
         # Ensure messages field exists in old sessions
         if "messages" not in SESSIONS[session_id]:
             SESSIONS[session_id]["messages"] = []
@@ -96,54 +273,98 @@ def add_to_conversation(session_id: str, user_text: str, assistant_text: str):
     if assistant_text:
         STATE["messages"].append(AIMessage(content=assistant_text))
     
-    save_sessions()
+    save_sessions(session_id)
+
+
+def _strip_marks(s: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", s) if unicodedata.category(c) != "Mn")
 
 
+# Per-character folding of Latin-1 and Latin Extended-A/B (á -> a, ñ -> n, ½ -> 1⁄2, ...).
+# None of these code points is a combining mark, so folding them one by one gives exactly
+# what NFKD + dropping marks gives for the whole string.
+_LATIN_MAX = "\u024f"
+_LATIN_FOLD = str.maketrans({
+    chr(cp): folded
+    for cp in range(0x80, ord(_LATIN_MAX) + 1)
+    if (folded := _strip_marks(chr(cp))) != chr(cp)
+})
+
+
+# Every detector re-normalizes the same user_text, so a turn pays for it only once
+@lru_cache(maxsize=512)
 def _normalize(s: str) -> str:
-    s = s or ""
-    return "".join(
-        c for c in unicodedata.normalize("NFKD", s.lower()) if unicodedata.category(c) != "Mn"
-    )
+    s = (s or "").lower()
+    # Fast paths for plain ASCII and Spanish/Latin text; anything else takes the full NFKD route
+    if s.isascii():
+        return s
+    if max(s) <= _LATIN_MAX:
+        return s.translate(_LATIN_FOLD)
+    return _strip_marks(s)
+
+
+# Intent detectors run on every turn: their patterns are compiled once here rather than
+# looked up in re's internal cache on each call.
+def _any_of(*patterns: str, flags: int = 0) -> re.Pattern:
+    """One alternation for a detector's pattern list, so a check is a single scan of the text."""
+    return re.compile("|".join(f"(?:{p})" for p in patterns), flags)
+
+
+_UUID_RE = re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b")
 
 
 def _extract_uuid(s: str) -> str | None:
-    if not s:
+    # A UUID has four hyphens; most chat turns have none, so skip the regex scan
+    if not s or s.count("-") < 4:
         return None
-    m = re.search(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b", s)
+    m = _UUID_RE.search(s)
     return m.group(0) if m else None
 
 
+# Substring alternations (not word matches), same semantics as the `in` checks they replace
+_LIST_INDICATORS_RE = _any_of(*map(re.escape, [
+    "lista", "listar", "ver", "mostrar", "muestrame", "mostrame",
+    "ensename", "ensenarme", "hay", "tienes", "tengo", "tenemos",
+    "cuales", "cuantas", "que", "todas", "list", "show", "display", "cual",
+]))
+# Avoid confusion with "trabajar con propiedad X" or "crear propiedad"
+_LIST_DISQUALIFIERS_RE = _any_of(*map(re.escape, ["trabajar", "usar", "con la propiedad", "crear", "nueva", "add", "create"]))
+
+
 def _wants_list_properties(text: str) -> bool:
     t = _normalize(text)
-    # Simple keyword combinations
-    if "propiedades" in t or "properties" in t:
-        # Check for list-like verbs or questions
-        list_indicators = ["lista", "listar", "ver", "mostrar", "muestrame", "mostrame", 
-                          "ensename", "ensenarme", "hay", "tienes", "tengo", "tenemos",
-                          "cuales", "cuantas", "que", "todas", "list", "show", "display",
-                          "cual", "cuál", "qué"]
-        for indicator in list_indicators:
-            if indicator in t:
-                # Avoid confusion with "trabajar con propiedad X" or "crear propiedad"
-                if not any(x in t for x in ["trabajar", "usar", "con la propiedad", "crear", "nueva", "add", "create"]):
-                    return True
-    return False
+    # Simple keyword combinations: list-like verbs or questions about properties
+    if "propiedades" not in t and "properties" not in t:
+        return False
+    return bool(_LIST_INDICATORS_RE.search(t)) and not _LIST_DISQUALIFIERS_RE.search(t)
+
+
+# More flexible detection - allow "anadir/añadir" even without "propiedad" explicitly
+_CREATE_PROPERTY_RE = _any_of(
+    r"\b(crear|crea|nueva)\s+(propiedad|property)\b",
+    r"\b(anadir|añadir|agregar|add)\s+(una\s+)?(nueva\s+)?(propiedad|property)\b",
+    r"\b(quiero|me\s+gustaria|me\s+gustaría|deseo)\s+(crear|anadir|añadir|agregar)\b",
+    r"\b(alta|dar\s+de\s+alta)\s+(propiedad|property)\b",
+    r"\b(nueva\s+propiedad)\b",
+)
 
 
 def _wants_create_property(text: str) -> bool:
     t = _normalize(text)
-    # More flexible detection - allow "anadir/añadir" even without "propiedad" explicitly
-    patterns = [
-        r"\b(crear|crea|nueva)\s+(propiedad|property)\b",
-        r"\b(anadir|añadir|agregar|add)\s+(una\s+)?(nueva\s+)?(propiedad|property)\b",
-        r"\b(quiero|me\s+gustaria|me\s+gustaría|deseo)\s+(crear|anadir|añadir|agregar)\b",
-        r"\b(alta|dar\s+de\s+alta)\s+(propiedad|property)\b",
-        r"\b(nueva\s+propiedad)\b",
-    ]
-    for p in patterns:
-        if re.search(p, t):
-            return True
-    return False
+    return bool(_CREATE_PROPERTY_RE.search(t))
+
+
+_NAME_STOP = r"(?=\s*(?:,|;|\.|$|\by\b|\band\b|\baddress\b|\bdirecci[oó]n\b))"
+_NAME_RES = tuple(re.compile(p, re.IGNORECASE) for p in (
+    rf"\bname\s*[:\-]?\s*(.+?){_NAME_STOP}",
+    rf"\bnombre\s*[:\-]?\s*(.+?){_NAME_STOP}",
+    rf"se\s+llama\s+(.+?){_NAME_STOP}",
+))
+_ADDR_RES = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r"\baddress\s*(?:es)?\s*[:\-]?\s*(.+?)(?=\s*(?:,|;|\.|$))",
+    r"\bdirecci[oó]n\s*(?:es)?\s*[:\-]?\s*(.+?)(?=\s*(?:,|;|\.|$))",
+))
+_TRAILING_AND_RE = re.compile(r"(?i)\b(and|y)\b\s*$")
 
 
 def _extract_name_address(user_text: str):
@@ -152,116 +373,123 @@ def _extract_name_address(user_text: str):
     s = user_text.strip()
 
     def first_match(patterns):
-        for p in patterns:
-            m = re.search(p, s, flags=re.IGNORECASE)
+        for rx in patterns:
+            m = rx.search(s)
             if m:
                 val = m.group(1).strip()
-                val = re.sub(r"(?i)\b(and|y)\b\s*$", "", val).strip()
+                val = _TRAILING_AND_RE.sub("", val).strip()
                 return val
         return None
 
-    stop = r"(?=\s*(?:,|;|\.|$|\by\b|\band\b|\baddress\b|\bdirecci[oó]n\b))"
-    name_patterns = [
-        rf"\bname\s*[:\-]?\s*(.+?){stop}",
-        rf"\bnombre\s*[:\-]?\s*(.+?){stop}",
-        rf"se\s+llama\s+(.+?){stop}",
-    ]
-    addr_patterns = [
-        r"\baddress\s*(?:es)?\s*[:\-]?\s*(.+?)(?=\s*(?:,|;|\.|$))",
-        r"\bdirecci[oó]n\s*(?:es)?\s*[:\-]?\s*(.+?)(?=\s*(?:,|;|\.|$))",
-    ]
-    name = first_match(name_patterns)
-    address = first_match(addr_patterns)
+    name = first_match(_NAME_RES)
+    address = first_match(_ADDR_RES)
     return name, address
 
 
+_PROPERTY_QUERY_RE = re.compile(r"(?i)propiedad\s*(?:que\s*se\s*llama|llamada|de\s*nombre)?\s*([\w\s\-\.]+)")
+_TRAILING_PREP_RE = re.compile(r"\s*(?:para|con|en|de)\s*$", re.IGNORECASE)
+
+
 def _extract_property_query(user_text: str) -> str | None:
     if not user_text:
         return None
-    m = re.search(r"(?i)propiedad\s*(?:que\s*se\s*llama|llamada|de\s*nombre)?\s*([\w\s\-\.]+)", user_text)
+    m = _PROPERTY_QUERY_RE.search(user_text)
     if m:
         candidate = m.group(1).strip()
-        candidate = re.sub(r"\s*(?:para|con|en|de)\s*$", "", candidate, flags=re.IGNORECASE)
+        candidate = _TRAILING_PREP_RE.sub("", candidate)
         if 2 <= len(candidate) <= 120:
             return candidate
     return None
 
 
+# Common Spanish patterns with expanded verb list
+_PROPERTY_CANDIDATE_RES = tuple(re.compile(p) for p in (
+    # Original patterns
+    r"(?i)(?:trabajar|usar|utilizar)\s+(?:con|en)\s+(?:la\s+propiedad\s+)?(.+)$",
+    r"(?i)quiero\s+(?:trabajar|usar|utilizar)\s+(?:con|en)\s+(?:la\s+propiedad\s+)?(.+)$",
+    # New informal patterns
+    r"(?i)(?:metete|meter|vamos|voy|ir|irme|pasamos|pasar)\s+(?:en|a|con)\s+(?:la\s+propiedad\s+)?(.+)$",
+    r"(?i)(?:me\s+voy|nos\s+vamos)\s+(?:a|en)\s+(?:la\s+propiedad\s+)?(.+)$",
+    # Direct "casa/finca + name" extraction
+    r"(?i)(?:metete|meter|vamos|voy|ir|irme|pasamos|pasar|en|a)\s+(?:la\s+)?(?:casa|finca|propiedad)\s+(.+)$",
+))
+_TRAILING_PUNCT_RE = re.compile(r"[\.,;:!\?]+$")
+_TRAILING_POLITE_RE = re.compile(r"\s+(por\s+favor|gracias)$", re.IGNORECASE)
+
+
 def _extract_property_candidate_from_text(user_text: str) -> str | None:
     """Extract a likely property name when phrased as 'trabajar/usar/metete con/en X'."""
     if not user_text:
         return None
-    # Common Spanish patterns with expanded verb list
-    patterns = [
-        # Original patterns
-        r"(?i)(?:trabajar|usar|utilizar)\s+(?:con|en)\s+(?:la\s+propiedad\s+)?(.+)$",
-        r"(?i)quiero\s+(?:trabajar|usar|utilizar)\s+(?:con|en)\s+(?:la\s+propiedad\s+)?(.+)$",
-        # New informal patterns
-        r"(?i)(?:metete|meter|vamos|voy|ir|irme|pasamos|pasar)\s+(?:en|a|con)\s+(?:la\s+propiedad\s+)?(.+)$",
-        r"(?i)(?:me\s+voy|nos\s+vamos)\s+(?:a|en)\s+(?:la\s+propiedad\s+)?(.+)$",
-        # Direct "casa/finca + name" extraction
-        r"(?i)(?:metete|meter|vamos|voy|ir|irme|pasamos|pasar|en|a)\s+(?:la\s+)?(?:casa|finca|propiedad)\s+(.+)$",
-    ]
-    for p in patterns:
-        m = re.search(p, user_text)
+    for rx in _PROPERTY_CANDIDATE_RES:
+        m = rx.search(user_text)
         if m:
             cand = m.group(1).strip()
             # Trim trailing polite words/punctuation
-            cand = re.sub(r"[\.,;:!\?]+$", "", cand)
-            cand = re.sub(r"\s+(por\s+favor|gracias)$", "", cand, flags=re.IGNORECASE)
+            cand = _TRAILING_PUNCT_RE.sub("", cand)
+            cand = _TRAILING_POLITE_RE.sub("", cand)
             if 2 <= len(cand) <= 120:
                 return cand
     return None
 
 
+_SWITCH_VERB_RE = re.compile(r"\b(trabajar|usar|utilizar|cambiar|switch|metete|meter|vamos|voy|ir|irme|pasamos|pasar)\b")
+_SWITCH_PREP_RE = re.compile(r"\b(con|en|a)\b")
+_PROPERTY_WORD_RE = re.compile(r"\b(propiedad|property)\b")
+_PROPERTY_HINT_RE = re.compile(r"(llama|llamada|nombre|direcci[oó]n|address|trabajar|usar|con|en|a|quiero|cambiar)")
+_NUMBERED_PROPERTY_RE = re.compile(r"\b(casa|finca|propiedad)\s+(demo|rural|[a-z]+)\s*\d+", re.IGNORECASE)
+_MOVE_VERB_RE = re.compile(r"\b(metete|meter|vamos|voy|ir|irme|pasamos|pasar|en|a)\b")
+
+
 def _wants_property_search(text: str) -> bool:
     t = _normalize(text)
     # Ignore generic plural list requests
     if "propiedades" in t or "properties" in t:
         return False
     # Work with / switch to a property - expanded verb list
-    if re.search(r"\b(trabajar|usar|utilizar|cambiar|switch|metete|meter|vamos|voy|ir|irme|pasamos|pasar)\b", t) and (re.search(r"\bcon\b", t) or re.search(r"\ben\b", t) or re.search(r"\ba\b", t)):
+    if _SWITCH_VERB_RE.search(t) and _SWITCH_PREP_RE.search(t):
         return True
     # "Quiero trabajar en/ con ...", "usar ...", "cambiar a ..."
-    if re.search(r"\b(propiedad|property)\b", t) and re.search(r"(llama|llamada|nombre|direcci[oó]n|address|trabajar|usar|con|en|a|quiero|cambiar)", t):
+    if _PROPERTY_WORD_RE.search(t) and _PROPERTY_HINT_RE.search(t):
         return True
     # Direct mention of "casa" or property name with movement verbs
-    if re.search(r"\b(casa|finca|propiedad)\s+(demo|rural|[a-z]+)\s*\d+", t, re.IGNORECASE) and re.search(r"\b(metete|meter|vamos|voy|ir|irme|pasamos|pasar|en|a)\b", t):
+    if _NUMBERED_PROPERTY_RE.search(t) and _MOVE_VERB_RE.search(t):
         return True
     return False
 
 
+_UPLOADED_DOCS_RE = _any_of(
+    r"\bque\s+documentos\s+(tengo|hay|he\s+subido)\b",
+    r"\b(documentos)\b.*\b(ya|subidos|subido)\b",
+    r"\b(cuales|que|qué)\s+documentos\b.*\b(tengo|hay)\b",
+    r"\b(which|what)\s+documents\b.*\b(have|uploaded|already)\b",
+)
+
+
 def _wants_uploaded_docs(text: str) -> bool:
     t = _normalize(text)
-    regexes = [
-        r"\bque\s+documentos\s+(tengo|hay|he\s+subido)\b",
-        r"\b(documentos)\b.*\b(ya|subidos|subido)\b",
-        r"\b(cuales|que|qué)\s+documentos\b.*\b(tengo|hay)\b",
-        r"\b(which|what)\s+documents\b.*\b(have|uploaded|already)\b",
-    ]
-    for rx in regexes:
-        if re.search(rx, t):
-            return True
-    return False
+    return bool(_UPLOADED_DOCS_RE.search(t))
+
+
+_MISSING_DOCS_RE = _any_of(
+    # español
+    r"\b(documentos?)\b.*\b(faltan|falta|pendientes|por\s+(subir|anadir|añadir|cargar))\b",
+    r"\b(cuales|que|qué)\s+documentos\b.*\b(faltan|falta|pendientes)\b",
+    r"\b(que|qué)\s+documentos\s+me\s+faltan\b",
+    r"\b(que|qué)\s+me\s+falta\b.*\b(documentos?)\b",
+    r"\b(no\s+he\s+subido|aun\s+no\s+he\s+subido|todavia\s+no\s+he\s+subido|todavía\s+no\s+he\s+subido)\b",
+    # inglés
+    r"\b(documents?)\b.*\b(missing|pending|to\s+upload|to\s+add)\b",
+    r"\b(which|what)\s+documents?\b.*\b(missing|pending)\b",
+)
 
 
 def _wants_missing_docs(text: str) -> bool:
     t = _normalize(text)
-    regexes = [
-        # español
-        r"\b(documentos?)\b.*\b(faltan|falta|pendientes|por\s+(subir|anadir|añadir|cargar))\b",
-        r"\b(cuales|que|qué)\s+documentos\b.*\b(faltan|falta|pendientes)\b",
-        r"\b(que|qué)\s+documentos\s+me\s+faltan\b",
-        r"\b(que|qué)\s+me\s+falta\b.*\b(documentos?)\b",
-        r"\b(no\s+he\s+subido|aun\s+no\s+he\s+subido|todavia\s+no\s+he\s+subido|todavía\s+no\s+he\s+subido)\b",
-        # inglés
-        r"\b(documents?)\b.*\b(missing|pending|to\s+upload|to\s+add)\b",
-        r"\b(which|what)\s+documents?\b.*\b(missing|pending)\b",
-    ]
-    for rx in regexes:
-        if re.search(rx, t):
-            return True
-    return False
+    return bool(_MISSING_DOCS_RE.search(t))
+
+
+_EMAIL_WORD_RE = re.compile(r"\b(email|correo|mail)\b")
 
 
 def _wants_email(text: str) -> bool:
@@ -269,40 +497,36 @@ def _wants_email(text: str) -> bool:
     Requires mention of email/correo/mail or explicit phrases like 'email me'.
     """
     t = _normalize(text)
-    # Direct phrases
-    if "email me" in t or re.search(r"\bemail\b", t):
-        return True
-    if re.search(r"\b(correo|mail)\b", t):
-        return True
-    # Verb + email/correo
-    if re.search(r"\b(manda|mandame|envia|enviame|env\u00eda|env\u00edame|send)\b.*\b(email|correo|mail)\b", t):
-        return True
-    # 'por/al email/correo'
-    if re.search(r"\b(por|al)\b.*\b(email|correo|mail)\b", t):
-        return True
-    return False
+    if "mail" not in t and "correo" not in t:
+        return False
+    # Verb + email/correo and 'por/al email/correo' phrasings all contain the word itself
+    return "email me" in t or bool(_EMAIL_WORD_RE.search(t))
+
+
+_FOCUS_NUMBERS_RE = _any_of(
+    r"\b(numeros|números|numbers|number)\b",
+    r"\bframework\s+de\s+(los\s+)?n(ú|u)meros\b",
+    r"\b(enfocar|centrar|trabajar|empezar|iniciar|start)\s+(en|con)?\s*(los\s+)?(n(ú|u)meros|numbers|number)\b",
+)
 
 
 def _wants_focus_numbers(text: str) -> bool:
     t = _normalize(text)
-    # If it's a concrete action, don't treat it as pure focus
-    if _wants_list_numbers(text) or _wants_numbers_help(text) or _wants_set_number(text) or _parse_number_value(text) is not None:
+    if not _FOCUS_NUMBERS_RE.search(t):
         return False
-    patterns = [
-        r"\b(numeros|números|numbers|number)\b",
-        r"\bframework\s+de\s+(los\s+)?n(ú|u)meros\b",
-        r"\b(enfocar|centrar|trabajar|empezar|iniciar|start)\s+(en|con)?\s*(los\s+)?(n(ú|u)meros|numbers|number)\b",
-    ]
-    return any(re.search(p, t) for p in patterns)
+    # If it's a concrete action, don't treat it as pure focus
+    return not (_wants_list_numbers(text) or _wants_numbers_help(text) or _wants_set_number(text) or _parse_number_value(text) is not None)
+
+
+_LIST_NUMBERS_RE = _any_of(
+    r"\b(lista(me)?|ver|mostrar)\b.*\b(esquema|schema|items|lineas|líneas|framework|plantilla|tabla)\b.*\b(n(ú|u)meros|numbers|number)\b",
+    r"\b(esquema|schema|framework|plantilla|tabla)\b.*\b(n(ú|u)meros|numbers|number)\b",
+)
 
 
 def _wants_list_numbers(text: str) -> bool:
     t = _normalize(text)
-    patterns = [
-        r"\b(lista(me)?|ver|mostrar)\b.*\b(esquema|schema|items|lineas|líneas|framework|plantilla|tabla)\b.*\b(n(ú|u)meros|numbers|number)\b",
-        r"\b(esquema|schema|framework|plantilla|tabla)\b.*\b(n(ú|u)meros|numbers|number)\b",
-    ]
-    if any(re.search(p, t) for p in patterns):
+    if bool(_LIST_NUMBERS_RE.search(t)):
         return True
     # Also accept "numbers framework" or "framework numbers"
     if ("numbers" in t or "números" in t or "numeros" in t or "number" in t) and "framework" in t:
@@ -310,20 +534,25 @@ def _wants_list_numbers(text: str) -> bool:
     return False
 
 
+_NUMBERS_HELP_RE = _any_of(
+    r"\b(que|qué)\s+me\s+hace\s+falta\b.*\b(n(ú|u)meros|numbers|number|framework)\b",
+    r"\b(que|qué)\s+datos\b.*\b(mandar|enviar|aportar)\b.*\b(framework|n(ú|u)meros|numbers|number)\b",
+    r"\b(que|qué)\s+falt(a|an)\b.*\b(n(ú|u)meros|numbers|number|framework)\b",
+    r"\b(completar|rellenar)\b.*\b(n(ú|u)meros|numbers|number|framework)\b",
+)
+
+
 def _wants_numbers_help(text: str) -> bool:
     t = _normalize(text)
-    patterns = [
-        r"\b(que|qué)\s+me\s+hace\s+falta\b.*\b(n(ú|u)meros|numbers|number|framework)\b",
-        r"\b(que|qué)\s+datos\b.*\b(mandar|enviar|aportar)\b.*\b(framework|n(ú|u)meros|numbers|number)\b",
-        r"\b(que|qué)\s+falt(a|an)\b.*\b(n(ú|u)meros|numbers|number|framework)\b",
-        r"\b(completar|rellenar)\b.*\b(n(ú|u)meros|numbers|number|framework)\b",
-    ]
-    return any(re.search(p, t) for p in patterns)
+    return bool(_NUMBERS_HELP_RE.search(t))
+
+
+_CALC_NUMBERS_RE = re.compile(r"\b(calcula|calcular|recalcula|recalcular|compute|calc)\b.*\b(n(ú|u)meros|numbers|totales|resumen)\b")
 
 
 def _wants_calc_numbers(text: str) -> bool:
     t = _normalize(text)
-    return bool(re.search(r"\b(calcula|calcular|recalcula|recalcular|compute|calc)\b.*\b(n(ú|u)meros|numbers|totales|resumen)\b", t))
+    return bool(_CALC_NUMBERS_RE.search(t))
 
 
 def _wants_frameworks_info(text: str) -> bool:
@@ -331,51 +560,41 @@ def _wants_frameworks_info(text: str) -> bool:
     return ("frameworks" in t or "esquemas" in t) and any(w in t for w in ("que", "qué", "hay", "cuales", "cuáles", "listar", "ver"))
 
 
+# The numeric part of a token; a trailing "%" (with optional spaces) is matched but not captured
+_NUMBER_TOKEN_RE = re.compile(r"([-+]?\d[\d\.,]*)\s*%?")
+
+
 def _parse_number_value(text: str) -> float | None:
     """Extract numeric value robustly (supports 1.234,56 | 1,234.56 | 1000.0 | 1.000 | 7%)."""
-    m = re.search(r"[-+]?\d[\d\.,]*\s*%?", text)
+    m = _NUMBER_TOKEN_RE.search(text)
     if not m:
         return None
-    token = m.group(0).strip()
-    token = token.replace(" ", "").replace("%", "")
-    # Both separators present: last one is decimal
-    if "," in token and "." in token:
-        last_dot = token.rfind('.')
-        last_comma = token.rfind(',')
-        if last_dot > last_comma:
-            token = token.replace(',', '')  # dot is decimal
-        else:
-            token = token.replace('.', '')
-            token = token.replace(',', '.')
-    elif "," in token:
-        if token.count(',') > 1:
-            last = token.rfind(',')
-            token = token[:last].replace(',', '') + '.' + token[last+1:]
+    token = m.group(1)
+    last_dot, last_comma = token.rfind('.'), token.rfind(',')
+    if last_dot >= 0 and last_comma >= 0:
+        # Both separators present: last one is decimal
+        token = token.replace(',', '') if last_dot > last_comma else token.replace('.', '').replace(',', '.')
+    elif last_dot >= 0 or last_comma >= 0:
+        sep, last = ('.', last_dot) if last_dot >= 0 else (',', last_comma)
+        head, tail = token[:last], token[last + 1:]
+        if sep in head:
+            # Repeated separator: only the last one can be decimal
+            token = head.replace(sep, '') + '.' + tail
+        elif head.isdigit() and len(tail) == 3:
+            # 1.000 / 1,000 are thousands
+            token = head + tail
         else:
-            parts = token.split(',')
-            if len(parts) == 2 and len(parts[1]) == 3 and parts[0].isdigit():
-                token = parts[0] + parts[1]
-            else:
-                token = token.replace(',', '.')
-    elif "." in token:
-        if token.count('.') > 1:
-            last = token.rfind('.')
-            token = token[:last].replace('.', '') + '.' + token[last+1:]
-        else:
-            before, after = token.split('.')
-            if before.isdigit() and len(after) == 3:
-                token = before + after
+            token = head + '.' + tail
     try:
         return float(token)
     except Exception:
         return None
 
 
-def _numbers_match_item(items: list[dict], text: str) -> dict | None:
-    """Find the best matching item by label or key tokens in the user text."""
-    t = _normalize(text)
-    # 1) Quick pass by synonyms for robust Spanish phrasing
-    synonyms_map = {
+# Synonyms per numbers item_key, normalized once at import
+_NUMBER_ITEM_SYNONYMS = {
+    item_key: tuple(_normalize(s) for s in syns)
+    for item_key, syns in {
         "impuestos_pct": ["impuestos", "impuesto", "iva", "itp", "iba"],
         "precio_venta": ["precio de venta", "precio", "venta"],
         "costes_construccion": ["costes de construccion", "costes de construcción", "construccion", "construcción", "obra"],
@@ -386,11 +605,18 @@ def _numbers_match_item(items: list[dict], text: str) -> dict | None:
         "total_pagado": ["total pagado", "pagado"],
         "terreno_urbano": ["terreno urbano", "urbano"],
         "terreno_rustico": ["terreno rustico", "terreno rústico", "rustico", "rústico"],
-    }
+    }.items()
+}
+
+
+def _numbers_match_item(items: list[dict], text: str) -> dict | None:
+    """Find the best matching item by label or key tokens in the user text."""
+    t = _normalize(text)
+    # 1) Quick pass by synonyms for robust Spanish phrasing
     key_to_item = {it.get("item_key"): it for it in items}
-    for item_key, syns in synonyms_map.items():
+    for item_key, syns in _NUMBER_ITEM_SYNONYMS.items():
         if item_key in key_to_item:
-            if any(_normalize(s) in t for s in syns):
+            if any(s in t for s in syns):
                 return key_to_item[item_key]
 
     best = None
@@ -450,14 +676,16 @@ def _wants_numbers_what_if(text: str) -> bool:
     return any(w in t for w in ["what if", "que pasa si", "qué pasa si", "si ", "escenario", "scenario", "sensitivity", "sensibilidad"]) and ("%" in text or "-" in text or "+" in text)
 
 
+# Patterns like 'var -10%' or 'var +12%', and 'sube/baja X%' after a key mentioned before
+_PERCENT_CHANGE_RE = re.compile(r"([A-Za-z_áéíóúüñ\s]+?)\s*([+-]?\d+(?:[\.,]\d+)?)\s*%", re.IGNORECASE)
+_PERCENT_VERB_RE = re.compile(r"(sube|baja|aumenta|reduce)\s*([+-]?\d+(?:[\.,]\d+)?)\s*%", re.IGNORECASE)
+
+
 def _parse_percent_changes(text: str) -> dict[str, float]:
     """Extract deltas like 'precio_venta -10%' or 'costes de construcción +12%' into fractional dict."""
     out: dict[str, float] = {}
     t = text
-    import re
-    # Patterns like 'var -10%' or 'var +12%'
-    pat = re.compile(r"([A-Za-z_áéíóúüñ\s]+?)\s*([+-]?\d+(?:[\.,]\d+)?)\s*%", re.IGNORECASE)
-    for m in pat.finditer(t):
+    for m in _PERCENT_CHANGE_RE.finditer(t):
         raw_key = m.group(1).strip()
         num = m.group(2).replace(",", ".")
         try:
@@ -470,7 +698,7 @@ def _parse_percent_changes(text: str) -> dict[str, float]:
     # Also allow verbs 'sube/baja X%' after a key mentioned before
     if not out:
         # Heuristic: look for 'sube|baja|aumenta|reduce' and the closest known key
-        verbs = re.findall(r"(sube|baja|aumenta|reduce)\s*([+-]?\d+(?:[\.,]\d+)?)\s*%", t, flags=re.IGNORECASE)
+        verbs = _PERCENT_VERB_RE.findall(t)
         if verbs:
             # pick last mentioned known key in text
             for k in _key_synonyms().keys():
@@ -507,66 +735,117 @@ def _wants_chart_sensitivity(text: str) -> bool:
     return any(w in t for w in ["sensibilidad", "heatmap", "matriz"])
 
 
+_SET_VERB_RE = re.compile(r"\b(pon|ponme|asigna|define|actualiza|set|establece)\b")
+_IS_NUMBER_RE = re.compile(r"\bes\s+[-+]?\d")
+
+
 def _wants_set_number(text: str) -> bool:
     t = _normalize(text)
     # Look for verbs or assignment patterns
-    if re.search(r"\b(pon|ponme|asigna|define|actualiza|set|establece)\b", t):
+    if _SET_VERB_RE.search(t):
         return True
-    if re.search(r"=", text):
+    if "=" in text:
         return True
     # Pattern "X es 123"
-    if re.search(r"\bes\s+[-+]?\d", t):
+    if _IS_NUMBER_RE.search(t):
         return True
     # If there's a number and we are in numbers focus, we'll try to interpret later
     return False
 
 
+_EMAIL_ADDRESS_RE = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+
+
+def _download_attachment(url: str) -> bytes:
+    """Fetch a document for an email attachment (send_email needs the whole body as bytes)."""
+    import requests
+    resp = requests.get(url, timeout=30)
+    resp.raise_for_status()
+    return resp.content
+
+
+def _upload_and_sign(key: str, data: bytes, content_type: str, expires: int = 3600) -> str:
+    sb.storage.from_(BUCKET).upload(key, data, {"content-type": content_type, "upsert": "true"})
+    return sb.storage.from_(BUCKET).create_signed_url(key, expires)["signedURL"]
+
+
 def _extract_email(text: str) -> str | None:
     """Extract email address from text."""
-    pattern = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    match = re.search(pattern, text)
+    if "@" not in text:
+        return None
+    match = _EMAIL_ADDRESS_RE.search(text)
     return match.group(0) if match else None
 
 
+_SAME_EMAIL_RE = _any_of(*map(re.escape, [
+    "mismo email", "mismo correo", "misma direccion", "mismo",
+    "el mismo", "la misma", "ese email", "ese correo", "esa direccion",
+    "same email", "same address", "that email", "that address",
+]))
+
+
 def _wants_same_email(text: str) -> bool:
     """Check if user wants to use the same email as before."""
     t = _normalize(text)
-    same_indicators = [
-        "mismo email", "mismo correo", "misma direccion", "mismo",
-        "el mismo", "la misma", "ese email", "ese correo", "esa direccion",
-        "same email", "same address", "that email", "that address"
-    ]
-    return any(ind in t for ind in same_indicators)
+    return bool(_SAME_EMAIL_RE.search(t))
+
+
+_DOC_NAME_STOPWORDS = tuple(f" {sw} " for sw in ["de", "del", "de la", "el", "la", "los", "las", "un", "una", "sobre", "para"])
+
+
+def _strip_doc_stopwords(s: str) -> str:
+    for sw in _DOC_NAME_STOPWORDS:
+        s = s.replace(sw, " ")
+    return s
+
+
+# Short-lived list_docs() rows per property for name matching, which can run several times
+# per email flow. Uploads, seeding and purges made here drop the entry; anything else
+# (e.g. an upload through the agent) shows up once the TTL expires.
+_DOCS_CACHE_TTL = 30.0
+_docs_cache: Dict[str, tuple[float, list]] = {}
+
+
+def _cached_list_docs(pid: str) -> list:
+    hit = _docs_cache.get(pid)
+    if hit and time.monotonic() - hit[0] < _DOCS_CACHE_TTL:
+        return hit[1]
+    rows = list_docs(pid)
+    _docs_cache[pid] = (time.monotonic(), rows)
+    return rows
+
+
+def _invalidate_docs_cache(pid: str | None = None):
+    """Forget cached rows (and cached agent answers) for one property, or for all of them."""
+    if pid is None:
+        clear_response_cache()
+        _docs_cache.clear()
+    else:
+        invalidate_response_cache(pid)
+        _docs_cache.pop(pid, None)
 
 
 def _match_document_from_text(pid: str, text: str):
     """Match document name from text."""
     try:
-        rows = list_docs(pid)
+        rows = _cached_list_docs(pid)
     except Exception:
         return None
-    t = _normalize(text)
-    stopwords = ["de", "del", "de la", "el", "la", "los", "las", "un", "una", "sobre", "para"]
-    t_clean = t
-    for sw in stopwords:
-        t_clean = t_clean.replace(f" {sw} ", " ")
+    t_clean = _strip_doc_stopwords(_normalize(text))
     
     best = None
     best_score = 0
     for r in rows:
         if not r.get("storage_key"):
             continue
-        name = _normalize(r.get("document_name", ""))
-        name_clean = name
-        for sw in stopwords:
-            name_clean = name_clean.replace(f" {sw} ", " ")
+        name_clean = _strip_doc_stopwords(_normalize(r.get("document_name", "")))
         
         score = 0
         name_tokens = [tok for tok in name_clean.split() if len(tok) > 2]
-        if name_tokens and all(tok in t_clean for tok in name_tokens):
+        matched = sum(1 for tok in name_tokens if tok in t_clean)
+        if name_tokens and matched == len(name_tokens):
             score += 5
         elif name_tokens:
-            matched = sum(1 for tok in name_tokens if tok in t_clean)
             if matched >= len(name_tokens) * 0.7:
                 score += 4
             elif matched >= 2:
@@ -585,7 +864,7 @@ def _match_document_from_text(pid: str, text: str):
     return best if best_score >= 3 else None
 
 
-def run_turn(session_id: str, text: str = "", audio_wav_bytes: bytes | None = None,
+async def run_turn(session_id: str, text: str = "", audio_wav_bytes: bytes | None = None,
              property_id: str | None = None, file_tuple: tuple[str, bytes] | None = None) -> Dict[str, Any]:
     # Use the existing session state instead of creating a new one
     STATE = get_session(session_id)
@@ -598,17 +877,54 @@ def run_turn(session_id: str, text: str = "", audio_wav_bytes: bytes | None = No
         "property_id": property_id or STATE.get("property_id")
     }
     
-    print(f"[MEMORY DEBUG] Invoking agent with thread_id={session_id}, input={text[:50]}")
+    logger.debug("[memory] Invoking agent with thread_id=%s, input=%s", session_id, text[:50])
     
     # The checkpointer will automatically load and save the conversation history
-    result = agent.invoke(state, config={"configurable": {"thread_id": session_id}})
+    agent = await aget_app()
+    result = await agent.ainvoke(state, config={"configurable": {"thread_id": session_id}})
     
     msg_count = len(result.get("messages", []))
-    print(f"[MEMORY DEBUG] Result has {msg_count} messages in history")
+    logger.debug("[memory] Result has %s messages in history", msg_count)
     
     return result
 
 
+def _sse(payload: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def stream_turn(session_id: str, text: str, property_id: str | None = None):
+    """Like run_turn, but yields server-sent events: assistant token deltas as they are generated,
+    then a final {"done": true, "answer", "property_id"} event once the graph has finished."""
+    STATE = get_session(session_id)
+    state = {"input": text, "property_id": property_id or STATE.get("property_id")}
+    config = {"configurable": {"thread_id": session_id}}
+    agent = await aget_app()
+
+    async for chunk, meta in agent.astream(state, config=config, stream_mode="messages"):
+        # Only user-facing text: skip the summarizer and tool-call chunks (they'd stutter as raw JSON)
+        if meta.get("langgraph_node") not in ("entry", "assistant", "tools") or not isinstance(chunk, AIMessage):
+            continue
+        if getattr(chunk, "tool_call_chunks", None) or chunk.tool_calls or not isinstance(chunk.content, str):
+            continue
+        if chunk.content:
+            yield _sse({"delta": chunk.content})
+
+    values = (await agent.aget_state(config)).values
+    answer = ""
+    for msg in reversed(values.get("messages", [])):
+        if isinstance(msg, AIMessage) and msg.content and not msg.tool_calls:
+            answer = str(msg.content)
+            break
+    if values.get("property_id") and values["property_id"] != STATE.get("property_id"):
+        STATE["property_id"] = values["property_id"]
+    if answer:
+        # So a follow-up like "mándalo por email" sends this answer
+        STATE["last_assistant_response"] = answer
+    save_sessions(session_id)
+    yield _sse({"done": True, "answer": answer or "(sin respuesta)", "property_id": STATE.get("property_id")})
+
+
 # Minimal HTTP app to support the Next.js frontend
 app = FastAPI(title="RAMA AI Backend")
 app.add_middleware(
@@ -619,6 +935,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def _build_agent():
+    # The async checkpointer has to be opened inside the running event loop
+    await aget_app()
+
+
+@app.on_event("startup")
+async def _start_session_flusher():
+    global _dirty_sessions, _flush_task
+    _dirty_sessions = asyncio.Queue()
+    _flush_task = asyncio.create_task(_flush_sessions_loop())
+    await asyncio.to_thread(_sweep_pending_blobs)
+
+
+@app.on_event("shutdown")
+async def _stop_session_flusher():
+    global _dirty_sessions
+    _flush_task.cancel()
+    flush_sessions()
+    _dirty_sessions = None
+
+
+# Inline intent checks inside ui_chat, compiled once
+_PDF_NAME_RE = re.compile(r"([\w\-\.]+\.pdf)", re.IGNORECASE)
+_SUMMARY_PPT_RE = re.compile(r"\b(ficha\s+resumen\s+propiedad|resumen\s+en\s+ppt|powerpoint|pptx)\b")
+_MOCK_DOCS_RE = re.compile(r"\b(mock|falsos|simulados)\b.*\b(documentos|docs)\b")
+_PURGE_VERB_RE = re.compile(r"\b(borra|elimina|purga)\b")
+_PURGE_CONFIRM_RE = re.compile(r"\b(confir|confirmo|borra|elimina|purga)\b")
+_DOCUMENTOS_RE = re.compile(r"\b(documentos)\b")
+_ALL_PROPERTIES_RE = re.compile(r"\b(?:de\s+)?todas\s+las\s+propiedades\b")
+_SUMMARIZE_RE = re.compile(r"\b(resume|resumen|resumeme|resumir|summarize|summary)\b")
+
+
 @app.post("/ui_chat")
 async def ui_chat(
     text: str = Form(""),
@@ -633,14 +982,14 @@ async def ui_chat(
     
     # Debug logging for files and audio
     if files and len(files) > 0:
-        print(f"[DEBUG] Received {len(files)} file(s): {[f.filename for f in files]}")
+        logger.debug("Received %s file(s): %s", len(files), [f.filename for f in files])
     else:
-        print(f"[DEBUG] No files received")
+        logger.debug("No files received")
     
     if audio:
-        print(f"[DEBUG] Received audio file: {audio.filename}, size: {audio.size}")
+        logger.debug("Received audio file: %s, size: %s", audio.filename, audio.size)
     else:
-        print(f"[DEBUG] No audio file received")
+        logger.debug("No audio file received")
     
     def make_response(answer: str, extra: dict | None = None):
         resp = {"answer": answer, "property_id": STATE.get("property_id")}
@@ -662,25 +1011,21 @@ async def ui_chat(
     # Process audio if present
     if audio:
         try:
-            print(f"[DEBUG] Processing audio file...")
+            logger.debug("Processing audio file...")
             audio_bytes = await audio.read()
-            print(f"[DEBUG] Audio bytes length: {len(audio_bytes)}")
-            
-            # Convert to base64 for the voice tool
-            import base64
-            audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
+            logger.debug("Audio bytes length: %s", len(audio_bytes))
             
             # Use the voice processing function directly
             from tools.voice_tool import process_voice_input
-            voice_result = process_voice_input(audio_bytes, "es")
+            voice_result = await asyncio.to_thread(process_voice_input, audio_bytes, "es")
             
-            print(f"[DEBUG] Voice processing result: {voice_result}")
+            logger.debug("Voice processing result: %s", voice_result)
             
             if voice_result.get("success") and voice_result.get("text"):
                 # Use the transcribed text as the user input
                 user_text = voice_result["text"]
                 transcript = user_text
-                print(f"[DEBUG] Transcribed text: {user_text}")
+                logger.debug("Transcribed text: %s", user_text)
                 
                 # Add user message to state for better context
                 if "messages" not in STATE:
@@ -689,62 +1034,63 @@ async def ui_chat(
                     "role": "user",
                     "content": user_text
                 })
-                save_sessions()
+                save_sessions(session_id)
                 
                 # Continue with normal flow using the transcribed text
                 # Don't return here, let the normal processing continue
             else:
                 error_msg = voice_result.get("error", "Error procesando el audio")
-                print(f"[DEBUG] Voice processing error: {error_msg}")
+                logger.debug("Voice processing error: %s", error_msg)
                 return make_response(f"Lo siento, no pude procesar tu mensaje de voz: {error_msg}")
                 
         except Exception as e:
-            print(f"[DEBUG] Audio processing exception: {str(e)}")
+            logger.debug("Audio processing exception: %s", e)
             return make_response(f"Error procesando el audio: {str(e)}")
     
     # Debug logging
-    print(f"[DEBUG] session_id: {session_id}, property_id: {STATE.get('property_id')}, text: {user_text[:50]}")
+    logger.debug("session_id: %s, property_id: %s, text: %s", session_id, STATE.get('property_id'), user_text[:50])
     
     # If client passes property_id explicitly, pin it for this session
     if property_id:
         STATE["property_id"] = property_id
-        save_sessions()
-        print(f"[DEBUG] property_id provided by client: {property_id}")
+        save_sessions(session_id)
+        logger.debug("property_id provided by client: %s", property_id)
     
     # Extract UUID if mentioned
     mentioned_pid = _extract_uuid(user_text)
     if mentioned_pid:
         STATE["property_id"] = mentioned_pid
-        save_sessions()
-        print(f"[DEBUG] Set property_id to {mentioned_pid}")
+        save_sessions(session_id)
+        logger.debug("Set property_id to %s", mentioned_pid)
     
     # Check if user is just mentioning a property name (like "Casa demo 4") at the start of message
     # and try to auto-select it if it matches
     if not STATE.get("property_id") and len(user_text.split()) <= 5:
         # Short message, might be just a property name
         try:
-            hits = db_search_properties(user_text, limit=3)
+            hits = await asyncio.to_thread(db_search_properties, user_text, limit=3)
             if hits and len(hits) == 1:
                 # Only one match, auto-select it
                 chosen = hits[0]
                 STATE["property_id"] = chosen["id"]
-                save_sessions()
-                print(f"[DEBUG] Auto-selected property: {chosen['name']} ({chosen['id']})")
+                save_sessions(session_id)
+                logger.debug("Auto-selected property: %s (%s)", chosen['name'], chosen['id'])
         except:
             pass  # Silently fail if search doesn't work
 
     # If user referenced a filename but no file bytes arrived (e.g., UI sent only text like "📎 foo.pdf"), propose slot anyway
-    if len(files) == 0 and ("📎" in user_text or re.search(r"[\w\-\.]+\.pdf", user_text, flags=re.IGNORECASE)):
+    if len(files) == 0 and ("📎" in user_text or _PDF_NAME_RE.search(user_text)):
         pid = STATE.get("property_id")
         if not pid:
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
         try:
             # Try to extract first *.pdf from text
-            m = re.search(r"([\w\-\.]+\.pdf)", user_text, flags=re.IGNORECASE)
+            m = _PDF_NAME_RE.search(user_text)
             fname = m.group(1) if m else "documento.pdf"
-            proposal = propose_slot(fname, user_text)
+            proposal = await asyncio.to_thread(propose_slot, fname, user_text)
+            _clear_pending_proposal(STATE)
             STATE["pending_proposal"] = {"filename": fname, "proposal": proposal}
-            save_sessions()
+            save_sessions(session_id)
             g = proposal["document_group"]; sg = proposal.get("document_subgroup", ""); n = proposal["document_name"]
             return make_response(f"Propongo las siguientes ubicaciones:\n{fname}: {g} / {sg} / {n}\nAdjunta el archivo y responde 'sí' para confirmar.")
         except Exception as e:
@@ -759,29 +1105,26 @@ async def ui_chat(
         f = files[0]
         try:
             fname = f.filename or "archivo.pdf"
-            print(f"[DEBUG] Proposing slot for file: {fname}")
-            # Read and store file bytes in session for later confirmation
-            file_bytes = await f.read()
-            import base64
-            file_b64 = base64.b64encode(file_bytes).decode("utf-8")
-            
+            logger.debug("Proposing slot for file: %s", fname)
             # Suggest slot using filename; we can extend hint with `user_text` context
-            proposal = propose_slot(fname, user_text)
-            print(f"[DEBUG] Proposal: {proposal}")
+            proposal = await asyncio.to_thread(propose_slot, fname, user_text)
+            logger.debug("Proposal: %s", proposal)
+            _clear_pending_proposal(STATE)
             STATE["pending_proposal"] = {
                 "filename": fname,
                 "proposal": proposal,
-                "file_b64": file_b64,  # Store file bytes as base64
+                # Park the file on disk until the user confirms
+                "blob_path": await _spool_upload(f),
             }
-            save_sessions()
+            save_sessions(session_id)
             g = proposal["document_group"]
             sg = proposal.get("document_subgroup", "")
             n = proposal["document_name"]
             response_text = f"Propongo las siguientes ubicaciones:\n{fname}: {g} / {sg} / {n}\n¿Confirmas la subida? (sí/no)"
-            print(f"[DEBUG] Returning response: {response_text}")
+            logger.debug("Returning response: %s", response_text)
             return make_response(response_text)
         except Exception as e:
-            print(f"[DEBUG] Error proposing slot: {e}")
+            logger.debug("Error proposing slot: %s", e)
             return make_response(f"No he podido proponer ubicación: {e}")
 
     # Confirmation flow for last proposal
@@ -794,19 +1137,21 @@ async def ui_chat(
             try:
                 filename = STATE["pending_proposal"]["filename"]
                 proposal = STATE["pending_proposal"]["proposal"]
-                file_b64 = STATE["pending_proposal"].get("file_b64")
+                blob_path = STATE["pending_proposal"].get("blob_path")
+                file_b64 = STATE["pending_proposal"].get("file_b64")  # sessions saved before blobs
                 
-                if not file_b64:
+                if blob_path and os.path.exists(blob_path):
+                    with open(blob_path, "rb") as fh:
+                        file_bytes = fh.read()
+                elif file_b64:
+                    file_bytes = base64.b64decode(file_b64)
+                else:
                     # Fallback: no file was stored, ask user to reattach
-                    STATE["pending_proposal"] = None
-                    save_sessions()
+                    _clear_pending_proposal(STATE)
+                    save_sessions(session_id)
                     return make_response("No tengo el archivo guardado. Por favor, adjúntalo de nuevo.")
                 
-                # Decode file bytes from base64
-                import base64
-                file_bytes = base64.b64decode(file_b64)
-                
-                out = upload_and_link(
+                out = await asyncio.to_thread(upload_and_link,
                     pid,
                     file_bytes,
                     filename,
@@ -815,17 +1160,16 @@ async def ui_chat(
                     proposal["document_name"],
                     metadata={}
                 )
-                STATE["pending_proposal"] = None
-                save_sessions()
+                _invalidate_docs_cache(pid)
+                _clear_pending_proposal(STATE)
+                await asave_sessions(session_id)
                 
                 # Verify document was saved by reading it back
-                import logging
-                logger = logging.getLogger(__name__)
                 logger.info(f"✅ Document uploaded: {proposal['document_name']}")
                 
                 # Read back to verify
                 try:
-                    docs = list_docs(pid)
+                    docs = await asyncio.to_thread(list_docs, pid)
                     uploaded_doc = next((d for d in docs if d.get("document_name") == proposal["document_name"] and d.get("storage_key")), None)
                     if uploaded_doc:
                         logger.info(f"✅ Verified document in DB: {uploaded_doc.get('storage_key')}")
@@ -838,7 +1182,7 @@ async def ui_chat(
                 try:
                     from tools.rag_index import index_document
                     logger.info(f"🔍 Auto-indexing document for RAG: {proposal['document_name']}")
-                    index_result = index_document(
+                    index_result = await asyncio.to_thread(index_document,
                         pid,
                         proposal["document_group"],
                         proposal.get("document_subgroup", ""),
@@ -853,12 +1197,12 @@ async def ui_chat(
                 
                 return make_response(f"✅ Subido '{proposal['document_name']}'.")
             except Exception as e:
-                STATE["pending_proposal"] = None
-                save_sessions()
+                _clear_pending_proposal(STATE)
+                save_sessions(session_id)
                 return make_response(f"No he podido subir el documento: {e}")
         elif any(w in t for w in ["no", "cambia", "otra", "diferente"]):
-            STATE["pending_proposal"] = None
-            save_sessions()
+            _clear_pending_proposal(STATE)
+            save_sessions(session_id)
             return make_response("De acuerdo. Dime el grupo/subgrupo/nombre exacto o vuelve a adjuntar el archivo con una pista (por ejemplo 'Contrato arquitecto').")
     
     # Handle email requests - check if we're waiting for email first
@@ -870,7 +1214,7 @@ async def ui_chat(
         if not email_addr and _wants_same_email(user_text):
             email_addr = STATE.get("last_email_used")
             if email_addr:
-                print(f"[DEBUG] Using previous email (from pending): {email_addr}")
+                logger.debug("Using previous email (from pending): %s", email_addr)
         
         if email_addr:
             content_to_send = STATE.get("email_content", "")
@@ -882,19 +1226,17 @@ async def ui_chat(
             if document_ref:
                 try:
                     from tools.docs_tools import signed_url_for
-                    import requests
                     pid = STATE.get("property_id")
-                    url = signed_url_for(
+                    url = await asyncio.to_thread(signed_url_for,
                         pid,
                         document_ref["document_group"],
                         document_ref.get("document_subgroup", ""),
                         document_ref["document_name"],
                         expires=600
                     )
-                    resp = requests.get(url, timeout=30)
-                    resp.raise_for_status()
+                    data = await asyncio.to_thread(_download_attachment, url)
                     
-                    if resp.content:
+                    if data:
                         # Get the actual filename from storage_key if available
                         storage_key = document_ref.get("storage_key", "")
                         if storage_key:
@@ -902,12 +1244,12 @@ async def ui_chat(
                         else:
                             filename = document_ref["document_name"].replace(" ", "_") + ".pdf"
                         
-                        print(f"[DEBUG] Downloaded document: {filename}, size: {len(resp.content)} bytes")
-                        attachments.append((filename, resp.content))
+                        logger.debug("Downloaded document: %s, size: %s bytes", filename, len(data))
+                        attachments.append((filename, data))
                     else:
-                        print(f"[ERROR] Document downloaded but empty")
+                        logger.error("Document downloaded but empty")
                 except Exception as e:
-                    print(f"[ERROR] Could not download document: {e}")
+                    logger.error("Could not download document: %s", e)
             
             try:
                 # If we were waiting to send the Numbers Excel, (re)generate it now
@@ -915,11 +1257,11 @@ async def ui_chat(
                     try:
                         pid = STATE.get("property_id")
                         if pid:
-                            xlsx_bytes = generate_numbers_excel(pid)
+                            xlsx_bytes = await asyncio.to_thread(generate_numbers_excel, pid)
                             attachments.append(("numbers_framework.xlsx", xlsx_bytes))
                     except Exception:
                         pass
-                send_email(
+                await asyncio.to_thread(send_email,
                     to=[email_addr],
                     subject=subject,
                     html=f"<html><body><pre style='font-family: sans-serif; white-space: pre-wrap;'>{content_to_send}</pre></body></html>",
@@ -934,11 +1276,11 @@ async def ui_chat(
                 STATE["email_document"] = None
                 STATE["pending_numbers_excel"] = False
                 STATE["last_email_used"] = email_addr
-                save_sessions()
+                await asave_sessions(session_id)
                 return make_response(msg)
             except Exception as e:
                 STATE["pending_email"] = False
-                save_sessions()
+                save_sessions(session_id)
                 return make_response(f"❌ Error al enviar email: {e}")
         else:
             return make_response("No he podido extraer un email válido. Por favor, proporciona tu dirección de email (ejemplo: tu@email.com)")
@@ -951,7 +1293,7 @@ async def ui_chat(
         if not email_addr and _wants_same_email(user_text):
             email_addr = STATE.get("last_email_used")
             if email_addr:
-                print(f"[DEBUG] Using previous email: {email_addr}")
+                logger.debug("Using previous email: %s", email_addr)
         
         pid = STATE.get("property_id")
         
@@ -965,13 +1307,13 @@ async def ui_chat(
                 if email_addr:
                     # Send last response immediately
                     try:
-                        send_email(
+                        await asyncio.to_thread(send_email,
                             to=[email_addr],
                             subject="Información de RAMA AI",
                             html=f"<html><body><pre style='font-family: sans-serif; white-space: pre-wrap;'>{last_response}</pre></body></html>",
                         )
                         STATE["last_email_used"] = email_addr
-                        save_sessions()
+                        await asave_sessions(session_id)
                         return make_response(f"✅ Email enviado correctamente a {email_addr}")
                     except Exception as e:
                         return make_response(f"❌ Error al enviar email: {e}")
@@ -981,13 +1323,13 @@ async def ui_chat(
                     STATE["email_content"] = last_response
                     STATE["email_subject"] = "Información de RAMA AI"
                     STATE["email_document"] = None
-                    save_sessions()
+                    save_sessions(session_id)
                     return make_response("Por supuesto. ¿A qué dirección de email te lo envío?")
             else:
                 return make_response("No hay ninguna respuesta anterior para enviar. ¿Qué información te gustaría que te enviara?")
         
         # Check if user mentions a specific document
-        document_ref = _match_document_from_text(pid, user_text) if pid else None
+        document_ref = await asyncio.to_thread(_match_document_from_text, pid, user_text) if pid else None
         
         # If the user asks to send the numbers framework, generate Excel by default
         if STATE.get("focus") == "numbers" or ("framework" in _normalize(user_text) and ("numbers" in _normalize(user_text) or "numeros" in _normalize(user_text) or "números" in _normalize(user_text))):
@@ -995,19 +1337,19 @@ async def ui_chat(
                 return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
             try:
                 # Generate Excel and email
-                xlsx_bytes = generate_numbers_excel(pid)
+                xlsx_bytes = await asyncio.to_thread(generate_numbers_excel, pid)
                 if email_addr:
                     try:
                         # Always attach freshly generated Excel for numbers framework
-                        xlsx_bytes = generate_numbers_excel(pid)
-                        send_email(
+                        xlsx_bytes = await asyncio.to_thread(generate_numbers_excel, pid)
+                        await asyncio.to_thread(send_email,
                             to=[email_addr],
                             subject="Framework de números (Excel)",
                             html="<html><body><p>Adjunto el framework de números en Excel.</p></body></html>",
                             attachments=[("numbers_framework.xlsx", xlsx_bytes)]
                         )
                         STATE["last_email_used"] = email_addr
-                        save_sessions()
+                        await asave_sessions(session_id)
                         return make_response(f"✅ Enviado el framework de números en Excel a {email_addr}")
                     except Exception as e:
                         return make_response(f"❌ Error al enviar el Excel: {e}")
@@ -1018,7 +1360,7 @@ async def ui_chat(
                     STATE["email_subject"] = "Framework de números (Excel)"
                     STATE["email_document"] = None
                     # Stash the file bytes in memory for this session turn would require extra infra; fallback to recompute on submit.
-                    save_sessions()
+                    save_sessions(session_id)
                     return make_response("¿A qué dirección de email te lo envío? Enviaré un Excel (.xlsx).")
             except Exception as e:
                 return make_response(f"No he podido generar el Excel: {e}")
@@ -1029,19 +1371,18 @@ async def ui_chat(
                 # Send document immediately
                 try:
                     from tools.docs_tools import signed_url_for
-                    import requests
-                    url = signed_url_for(
+                    url = await asyncio.to_thread(signed_url_for,
                         pid,
                         document_ref["document_group"],
                         document_ref.get("document_subgroup", ""),
                         document_ref["document_name"],
                         expires=600
                     )
-                    resp = requests.get(url, timeout=30)
-                    resp.raise_for_status()  # Raise error if download failed
+                    # Raises if the download failed
+                    data = await asyncio.to_thread(_download_attachment, url)
                     
                     # Ensure we have content
-                    if not resp.content:
+                    if not data:
                         return make_response("❌ Error: el documento descargado está vacío")
                     
                     # Get the actual filename from storage_key if available
@@ -1052,16 +1393,16 @@ async def ui_chat(
                     else:
                         filename = document_ref["document_name"].replace(" ", "_") + ".pdf"
                     
-                    print(f"[DEBUG] Sending document: {filename}, size: {len(resp.content)} bytes")
+                    logger.debug("Sending document: %s, size: %s bytes", filename, len(data))
                     
-                    send_email(
+                    await asyncio.to_thread(send_email,
                         to=[email_addr],
                         subject=f"Documento: {document_ref['document_name']}",
                         html=f"<html><body><p>Aquí está el documento que solicitaste: {document_ref['document_name']}</p></body></html>",
-                        attachments=[(filename, resp.content)]
+                        attachments=[(filename, data)]
                     )
                     STATE["last_email_used"] = email_addr
-                    save_sessions()
+                    await asave_sessions(session_id)
                     return make_response(f"✅ Email enviado correctamente a {email_addr}\n📎 Documento adjunto: {filename}")
                 except Exception as e:
                     return make_response(f"❌ Error al enviar email: {e}")
@@ -1071,13 +1412,13 @@ async def ui_chat(
                 STATE["email_content"] = f"Documento: {document_ref['document_name']}"
                 STATE["email_subject"] = f"Documento: {document_ref['document_name']}"
                 STATE["email_document"] = document_ref
-                save_sessions()
+                save_sessions(session_id)
                 return make_response("Por supuesto. ¿A qué dirección de email te lo envío?")
         else:
             return make_response("¿Qué información te gustaría que te enviara por email? Especifica el documento o la información.")
     
     # Build summary PowerPoint on explicit request
-    if re.search(r"\b(ficha\s+resumen\s+propiedad|resumen\s+en\s+ppt|powerpoint|pptx)\b", _normalize(user_text)):
+    if _SUMMARY_PPT_RE.search(_normalize(user_text)):
         pid = STATE.get("property_id")
         if not pid:
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
@@ -1085,28 +1426,27 @@ async def ui_chat(
             # Fetch property info if available
             prop = None
             try:
-                prop = db_get_property(pid)
+                prop = await asyncio.to_thread(db_get_property, pid)
             except Exception:
                 prop = None
             name = (prop or {}).get("name") if isinstance(prop, dict) else None
             address = (prop or {}).get("address") if isinstance(prop, dict) else None
-            data = build_summary_ppt(pid, name, address, format="pdf")
+            data = await asyncio.to_thread(build_summary_ppt, pid, name, address, format="pdf")
             # Upload to storage and share URL
-            import time
             key = f"summaries/{pid}/summary_{int(time.time())}.pdf"
-            sb.storage.from_(BUCKET).upload(key, data, {"content-type": "application/pdf", "upsert": "true"})
-            url = sb.storage.from_(BUCKET).create_signed_url(key, 3600)["signedURL"]
+            url = await asyncio.to_thread(_upload_and_sign, key, data, "application/pdf")
             return make_response(f"Resumen (PDF) listo: {url}\nSi quieres te lo envío por email en este momento.")
         except Exception as e:
             return make_response(f"No he podido generar la ficha resumen: {e}")
 
     # Seed mock documents on request (simple trigger phrase)
-    if _normalize(user_text) in ["sembrar docs mock", "crear docs mock", "mock documentos", "rellena docs mock", "genera documentos mock"] or re.search(r"\b(mock|falsos|simulados)\b.*\b(documentos|docs)\b", _normalize(user_text)):
+    if _normalize(user_text) in ["sembrar docs mock", "crear docs mock", "mock documentos", "rellena docs mock", "genera documentos mock"] or _MOCK_DOCS_RE.search(_normalize(user_text)):
         pid = STATE.get("property_id")
         if not pid:
             return make_response("¿En qué propiedad trabajamos? Dime el nombre o el UUID.")
         try:
-            res = seed_mock_documents(pid, index_after=True)
+            res = await asyncio.to_thread(seed_mock_documents, pid, index_after=True)
+            _invalidate_docs_cache(pid)
             return make_response(f"✅ Documentos mock creados: {res.get('seeded', 0)}. {(len(res.get('errors', [])))} errores.")
         except Exception as e:
             return make_response(f"No he podido crear los documentos mock: {e}")
@@ -1121,7 +1461,7 @@ async def ui_chat(
         STATE["email_document"] = None
         STATE["focus"] = None
         try:
-            rows = db_list_properties(limit=30)
+            rows = await asyncio.to_thread(db_list_properties, limit=30)
             if not rows:
                 return make_response("No hay propiedades en la base de datos todavía.")
             lines = [f"- {r.get('name','(sin nombre)')} — {r.get('address','')}" for r in rows]
@@ -1131,13 +1471,14 @@ async def ui_chat(
 
     # Destructive: by default, purge documents ONLY for current property unless user explicitly says "todas las propiedades"
     norm = _normalize(user_text)
-    if re.search(r"\b(borra|elimina|purga)\b", norm) and re.search(r"\b(documentos)\b", norm) and not re.search(r"\b(?:de\s+)?todas\s+las\s+propiedades\b", norm):
+    if _PURGE_VERB_RE.search(norm) and _DOCUMENTOS_RE.search(norm) and not _ALL_PROPERTIES_RE.search(norm):
         pid = STATE.get("property_id")
         if not pid:
             return make_response("Primero selecciona una propiedad para poder borrar sus documentos.")
         try:
             from tools.docs_tools import purge_property_documents
-            res = purge_property_documents(pid)
+            res = await asyncio.to_thread(purge_property_documents, pid)
+            _invalidate_docs_cache(pid)
             return make_response(
                 f"✅ Eliminados los documentos de la propiedad actual. Ficheros borrados: {res.get('removed_files',0)}; celdas limpiadas: {res.get('cleared_rows',0)}."
             )
@@ -1145,10 +1486,11 @@ async def ui_chat(
             return make_response(f"❌ No he podido borrar los documentos de esta propiedad: {e}")
 
     # Destructive: purge all documents for all properties (requires explicit confirmation phrase)
-    if re.search(r"\b(confir|confirmo|borra|elimina|purga)\b", norm) and re.search(r"\b(?:de\s+)?todas\s+las\s+propiedades\b", norm):
+    if _PURGE_CONFIRM_RE.search(norm) and _ALL_PROPERTIES_RE.search(norm):
         try:
             from tools.docs_tools import purge_all_documents
-            res = purge_all_documents()
+            res = await asyncio.to_thread(purge_all_documents)
+            _invalidate_docs_cache()
             return make_response(f"✅ Eliminados documentos de {res.get('properties',0)} propiedades. Ficheros borrados: {res.get('removed_files',0)}; celdas limpiadas: {res.get('cleared_rows',0)}.")
         except Exception as e:
             return make_response(f"❌ No he podido borrar los documentos: {e}")
@@ -1156,7 +1498,7 @@ async def ui_chat(
     # If we were in a create flow but the user is clearly switching/listing, cancel create flow
     if STATE.get("pending_create") and (_wants_property_search(user_text) or _wants_list_properties(user_text)):
         STATE["pending_create"] = False
-        save_sessions()
+        save_sessions(session_id)
 
     # Create new property - check if we're in pending_create mode first
     if STATE.get("pending_create") or _wants_create_property(user_text):
@@ -1167,11 +1509,11 @@ async def ui_chat(
         # If we already extracted both in this turn, create immediately
         if name_val and addr_val:
             try:
-                row = db_add_property(name_val, addr_val)
+                row = await asyncio.to_thread(db_add_property, name_val, addr_val)
                 STATE["property_id"] = row["id"]
                 STATE["pending_create"] = False
-                save_sessions()
-                fr = list_frameworks(row["id"])
+                save_sessions(session_id)
+                fr = await asyncio.to_thread(list_frameworks, row["id"])
                 return make_response(
                     f"Trabajaremos con la propiedad: {row['name']} — {row['address']}\n"
                     f"He creado 2 plantillas por completar: Documentos y Números. ¿Por dónde quieres empezar?",
@@ -1179,11 +1521,11 @@ async def ui_chat(
                 )
             except Exception as e:
                 STATE["pending_create"] = False
-                save_sessions()
+                save_sessions(session_id)
                 return make_response(f"No he podido crear la propiedad: {e}")
         else:
             # Ask for missing info
-            save_sessions()
+            save_sessions(session_id)
             return make_response("Por favor, proporciona el nombre y la dirección de la propiedad. Ejemplo: 'nombre: Casa Demo 6 y dirección: Calle Alameda 22'")
     
     # EARLY EXIT FROM FOCUS MODE: If user wants to change property/context while in focus mode
@@ -1192,8 +1534,8 @@ async def ui_chat(
         if _wants_property_search(user_text) or _wants_list_properties(user_text) or _wants_create_property(user_text):
             # User wants to change property/context, exit focus mode
             STATE["focus"] = None
-            save_sessions()
-            print(f"[DEBUG] Exiting focus mode because user wants to change context: {user_text[:50]}")
+            save_sessions(session_id)
+            logger.debug("Exiting focus mode because user wants to change context: %s", user_text[:50])
             # Continue processing the property change request below
     
     # Search/switch to a specific property (takes precedence over create if both present)
@@ -1210,9 +1552,9 @@ async def ui_chat(
         prop_q = _extract_property_query(user_text) or _extract_property_candidate_from_text(user_text)
         query = prop_q or name_val or addr_val or user_text
         try:
-            hits = db_search_properties(query, limit=5)
+            hits = await asyncio.to_thread(db_search_properties, query, limit=5)
             if not hits:
-                rows = db_list_properties(limit=10)
+                rows = await asyncio.to_thread(db_list_properties, limit=10)
                 if rows:
                     lines = [f"- {r.get('name','(sin nombre)')} — {r.get('address','')}" for r in rows]
                     return make_response("No encontré coincidencias exactas. ¿Quisiste decir alguna de estas?\n" + "\n".join(lines) + "\n\nPuedes responder con el nombre tal cual, por ejemplo: 'Casa Demo 6'.")
@@ -1220,9 +1562,9 @@ async def ui_chat(
             if len(hits) == 1:
                 chosen = hits[0]
                 STATE["property_id"] = chosen["id"]
-                save_sessions()
-                print(f"[DEBUG] Property search - Set property_id to {chosen['id']} for session {session_id}")
-                fr = list_frameworks(chosen["id"])
+                save_sessions(session_id)
+                logger.debug("Property search - Set property_id to %s for session %s", chosen['id'], session_id)
+                fr = await asyncio.to_thread(list_frameworks, chosen["id"])
                 return make_response(
                     f"Trabajaremos con la propiedad: {chosen.get('name','(sin nombre)')} — {chosen.get('address','')}\n"
                     f"Tienes 2 plantillas por completar: Documentos y Números. ¿Por dónde quieres empezar?",
@@ -1240,7 +1582,7 @@ async def ui_chat(
         if not pid:
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
         try:
-            rows = list_docs(pid)
+            rows = await asyncio.to_thread(list_docs, pid)
             uploaded = [r for r in rows if r.get('storage_key')]
             if uploaded:
                 lines = [f"- {r['document_group']} / {r.get('document_subgroup','')} / {r['document_name']}" for r in uploaded[:10]]
@@ -1253,13 +1595,13 @@ async def ui_chat(
     # Focus numbers mode (also accept direct mentions like "numbers framework")
     if _wants_focus_numbers(user_text) or ("framework" in _normalize(user_text) and ("numbers" in _normalize(user_text) or "numeros" in _normalize(user_text) or "números" in _normalize(user_text))):
         STATE["focus"] = "numbers"
-        save_sessions()
+        save_sessions(session_id)
         # Mostrar la plantilla inmediatamente + resumen de acciones en español
         pid = STATE.get("property_id")
         if not pid:
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
         try:
-            items = get_numbers(pid)
+            items = await asyncio.to_thread(get_numbers, pid)
             if not items:
                 return make_response("No hay números configurados aún para esta propiedad.")
             lines = [f"- {it['group_name']} / {it['item_label']} ({it['item_key']}): {it['amount'] if it['amount'] is not None else '-'}" for it in items[:30]]
@@ -1276,7 +1618,7 @@ async def ui_chat(
         if not pid:
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
         try:
-            items = get_numbers(pid)
+            items = await asyncio.to_thread(get_numbers, pid)
             if not items:
                 return make_response("No hay números configurados aún para esta propiedad.")
             lines = [f"- {it['group_name']} / {it['item_label']} ({it['item_key']}): {it['amount'] if it['amount'] is not None else '-'}" for it in items[:30]]
@@ -1293,12 +1635,13 @@ async def ui_chat(
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
         try:
             # Use new Numbers Agent compute (persist outputs/logs) in addition to DB calc if present
-            _ = numbers_compute_and_log(pid, triggered_by="user", trigger_type="manual")
+            _ = await asyncio.to_thread(numbers_compute_and_log, pid, triggered_by="user", trigger_type="manual")
             # Keep legacy calc for compatibility if available
             try:
-                _ = calc_numbers(pid)
+                _ = await asyncio.to_thread(calc_numbers, pid)
             except Exception:
                 pass
+            invalidate_response_cache(pid)
             return make_response("✅ Cálculo realizado. He registrado el cálculo y validado anomalías. Puedes volver a pedir el esquema o solicitar gráficos o Excel.")
         except Exception as e:
             return make_response(f"No he podido calcular los números: {e}")
@@ -1309,7 +1652,7 @@ async def ui_chat(
         if not pid:
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
         try:
-            items = get_numbers(pid)
+            items = await asyncio.to_thread(get_numbers, pid)
             missing = [it for it in items if it.get("amount") in (None, 0, "", "null")]
             if not missing:
                 return make_response("¡Genial! El esquema de números ya está completo. Puedes actualizar valores diciendo, por ejemplo: 'pon presupuesto reforma a 25000'.")
@@ -1325,7 +1668,7 @@ async def ui_chat(
         if not pid:
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
         try:
-            items = get_numbers(pid)
+            items = await asyncio.to_thread(get_numbers, pid)
             item = _numbers_match_item(items, user_text)
             value = _parse_number_value(user_text)
             if not item or value is None:
@@ -1333,10 +1676,11 @@ async def ui_chat(
                 hint = "o 'pon presupuesto reforma a 25000'"
                 return make_response("No he entendido qué valor quieres cambiar. Dime, por ejemplo: 'pon ITP a 12000' " + hint)
             # Persist
-            result = set_number(pid, item["item_key"], float(value))
+            result = await asyncio.to_thread(set_number, pid, item["item_key"], float(value))
+            invalidate_response_cache(pid)
             # Auto-recalculate and log using Numbers Agent (no invented values)
             try:
-                comp = numbers_compute_and_log(pid, triggered_by="user", trigger_type="set_number")
+                comp = await asyncio.to_thread(numbers_compute_and_log, pid, triggered_by="user", trigger_type="set_number")
                 anomalies = comp.get("anomalies") or []
                 warn = ("\n⚠️ Anomalías: " + "; ".join(anomalies)) if anomalies else ""
             except Exception:
@@ -1351,7 +1695,7 @@ async def ui_chat(
         if not pid:
             return make_response("¿En qué propiedad estamos trabajando? Dime el nombre de la propiedad o el UUID.")
         try:
-            rows = list_docs(pid)
+            rows = await asyncio.to_thread(list_docs, pid)
             missing = [r for r in rows if not r.get('storage_key')]
             if missing:
                 lines = [f"- {r['document_group']} / {r.get('document_subgroup','')} / {r['document_name']}" for r in missing[:15]]
@@ -1363,15 +1707,15 @@ async def ui_chat(
     
     # Check for explicit summarize/resume request first
     qnorm = _normalize(user_text)
-    is_summarize_request = bool(re.search(r"\b(resume|resumen|resumeme|resumir|summarize|summary)\b", qnorm))
+    is_summarize_request = bool(_SUMMARIZE_RE.search(qnorm))
     
     pid = STATE.get("property_id")
     if is_summarize_request and pid:
         # User wants a summary of a document
-        doc_ref = _match_document_from_text(pid, user_text)
+        doc_ref = await asyncio.to_thread(_match_document_from_text, pid, user_text)
         if doc_ref:
             try:
-                result = rag_summarize(
+                result = await asyncio.to_thread(rag_summarize,
                     property_id=pid,
                     group=doc_ref.get("document_group", ""),
                     subgroup=doc_ref.get("document_subgroup", ""),
@@ -1381,10 +1725,10 @@ async def ui_chat(
                 if result.get("summary"):
                     answer_text = result["summary"]
                     STATE["last_assistant_response"] = answer_text
-                    save_sessions()
+                    save_sessions(session_id)
                     return make_response(answer_text)
             except Exception as e:
-                print(f"[DEBUG] Summarize failed: {e}, falling back to agent")
+                logger.debug("Summarize failed: %s, falling back to agent", e)
                 # Fall through to agent if summarize fails
     
     # Document question/RAG - Priority: any question about documents (but not summarize)
@@ -1396,11 +1740,11 @@ async def ui_chat(
     
     if is_question and pid:
         # Prioritize document mentioned in current text
-        doc_ref = _match_document_from_text(pid, user_text)
+        doc_ref = await asyncio.to_thread(_match_document_from_text, pid, user_text)
         try:
             if doc_ref:
                 # Search in specific document
-                result = qa_with_citations(
+                result = await asyncio.to_thread(qa_with_citations,
                     property_id=pid,
                     query=user_text,
                     top_k=6,
@@ -1410,7 +1754,7 @@ async def ui_chat(
                 )
             else:
                 # Search across ALL documents for the property
-                result = qa_with_citations(
+                result = await asyncio.to_thread(qa_with_citations,
                     property_id=pid,
                     query=user_text,
                     top_k=6
@@ -1425,11 +1769,11 @@ async def ui_chat(
                 
                 # Save this response for potential email sending
                 STATE["last_assistant_response"] = answer_text
-                save_sessions()
+                save_sessions(session_id)
                 
                 return make_response(answer_text)
         except Exception as e:
-            print(f"[DEBUG] QA with citations failed: {e}, falling back to agent")
+            logger.debug("QA with citations failed: %s, falling back to agent", e)
             # Fall through to agent if QA fails
     
     # If no specific intent matched, try Numbers NL router globally (even fuera de números)
@@ -1446,14 +1790,14 @@ async def ui_chat(
         # Garantiza que quedamos en modo números
         if STATE.get("focus") != "numbers":
             STATE["focus"] = "numbers"
-            save_sessions()
+            save_sessions(session_id)
         # what-if
         if wants_what_if:
             deltas = _parse_percent_changes(user_text)
             if not deltas:
                 return make_response("No he podido entender los cambios. Dime, por ejemplo: 'precio de venta -10% y construcción +12%'.")
             try:
-                out = numbers_what_if(pid, deltas, name="what_if_chat")
+                out = await asyncio.to_thread(numbers_what_if, pid, deltas, name="what_if_chat")
                 ans = "Escenario calculado. Net profit: {}".format(out.get("outputs", {}).get("net_profit"))
                 return make_response(ans)
             except Exception as e:
@@ -1461,7 +1805,7 @@ async def ui_chat(
         # break-even
         if wants_be:
             try:
-                out_be = numbers_break_even(pid, 1.0)
+                out_be = await asyncio.to_thread(numbers_break_even, pid, 1.0)
                 if out_be.get("error"):
                     return make_response("No hay datos suficientes para calcular el break-even.")
                 return make_response(f"Break-even en precio_venta ≈ {out_be['precio_venta']:.2f} (net_profit {out_be['net_profit']:.2f}).")
@@ -1469,12 +1813,12 @@ async def ui_chat(
                 return make_response(f"No he podido calcular el break-even: {e}")
         # charts
         if wants_wf:
-            out_wf = numbers_chart_waterfall(pid)
+            out_wf = await asyncio.to_thread(numbers_chart_waterfall, pid)
             if out_wf.get("signed_url"):
                 return make_response(f"Waterfall listo: {out_wf['signed_url']}")
             return make_response("No he podido generar el waterfall.")
         if wants_stack:
-            out_st = numbers_chart_cost_stack(pid)
+            out_st = await asyncio.to_thread(numbers_chart_cost_stack, pid)
             if out_st.get("signed_url"):
                 return make_response(f"Composición de costes lista: {out_st['signed_url']}")
             return make_response("No he podido generar el gráfico de composición.")
@@ -1482,17 +1826,17 @@ async def ui_chat(
             # default vectors
             precio_vec = [-0.2, -0.1, -0.05, 0.0, 0.05, 0.1, 0.2]
             costes_vec = [-0.15, -0.1, -0.05, 0.0, 0.05, 0.1, 0.15]
-            out_sens = numbers_chart_sensitivity(pid, precio_vec, costes_vec)
+            out_sens = await asyncio.to_thread(numbers_chart_sensitivity, pid, precio_vec, costes_vec)
             if out_sens.get("signed_url"):
                 return make_response(f"Sensibilidad lista: {out_sens['signed_url']}")
             return make_response("No he podido generar el heatmap de sensibilidad.")
 
-    out = run_turn(session_id=session_id, text=user_text, property_id=STATE.get("property_id"))
+    out = await run_turn(session_id=session_id, text=user_text, property_id=STATE.get("property_id"))
     
     # Update property_id if the agent changed it (messages are handled by PostgreSQL checkpointer)
     if out.get("property_id") and out["property_id"] != STATE.get("property_id"):
         STATE["property_id"] = out["property_id"]
-        save_sessions()
+        save_sessions(session_id)
     
     answer = out.get("answer") or out.get("content") or ""
     if not answer and out.get("messages"):
@@ -1505,17 +1849,42 @@ async def ui_chat(
             if content and not getattr(msg, "tool_calls", None):
                 answer = str(content)
                 break
+    if answer:
+        STATE["last_assistant_response"] = answer
+        save_sessions(session_id)
     
     # Include transcript if this was a voice input
-    print(f"[DEBUG] Final transcript value: {transcript}")
+    logger.debug("Final transcript value: %s", transcript)
     extra = {"transcript": transcript} if transcript else None
-    print(f"[DEBUG] Final response extra: {extra}")
+    logger.debug("Final response extra: %s", extra)
     return make_response(answer or "(sin respuesta)", extra)
+
+
+@app.post("/ui_chat/stream")
+async def ui_chat_stream(
+    text: str = Form(""),
+    session_id: str = Form("web-ui"),
+    property_id: str | None = Form(None),
+):
+    """Server-sent events variant of /ui_chat for plain text turns that go straight to the agent
+    (no files, audio or shortcut intents). Emits {"delta": ...} events, then a final {"done": true, ...}."""
+    STATE = get_session(session_id)
+    pid = property_id or _extract_uuid(text or "")
+    if pid and pid != STATE.get("property_id"):
+        STATE["property_id"] = pid
+        save_sessions(session_id)
+    return StreamingResponse(
+        stream_turn(session_id, text or "", STATE.get("property_id")),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
+
 # --- Minimal Numbers Agent endpoints for testing and UI integration ---
 @app.post("/numbers/compute")
 async def numbers_compute(property_id: str = Form(...)):
     try:
-        out = numbers_compute_and_log(property_id, triggered_by="api", trigger_type="manual")
+        out = await asyncio.to_thread(numbers_compute_and_log, property_id, triggered_by="api", trigger_type="manual")
         return JSONResponse(out)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
@@ -1524,7 +1893,7 @@ async def numbers_compute(property_id: str = Form(...)):
 @app.get("/numbers/excel")
 async def numbers_excel(property_id: str):
     try:
-        data = generate_numbers_excel(property_id)
+        data = await asyncio.to_thread(generate_numbers_excel, property_id)
         return Response(content=data, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={
             "Content-Disposition": "attachment; filename=numbers_framework.xlsx"
         })
@@ -1537,7 +1906,7 @@ async def numbers_whatif(property_id: str = Form(...), deltas_json: str = Form(.
     try:
         import json
         deltas = json.loads(deltas_json)
-        out = numbers_what_if(property_id, deltas, name)
+        out = await asyncio.to_thread(numbers_what_if, property_id, deltas, name)
         return JSONResponse(out)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
@@ -1549,7 +1918,7 @@ async def numbers_sensitivity(property_id: str = Form(...), precio_vec_json: str
         import json
         precio_vec = json.loads(precio_vec_json)
         costes_vec = json.loads(costes_vec_json)
-        out = numbers_sensitivity_grid(property_id, precio_vec, costes_vec)
+        out = await asyncio.to_thread(numbers_sensitivity_grid, property_id, precio_vec, costes_vec)
         return JSONResponse(out)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
@@ -1558,7 +1927,7 @@ async def numbers_sensitivity(property_id: str = Form(...), precio_vec_json: str
 @app.post("/numbers/break_even")
 async def numbers_breakeven(property_id: str = Form(...), tol: float = Form(1.0)):
     try:
-        out = numbers_break_even(property_id, tol)
+        out = await asyncio.to_thread(numbers_break_even, property_id, tol)
         return JSONResponse(out)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
@@ -1567,7 +1936,7 @@ async def numbers_breakeven(property_id: str = Form(...), tol: float = Form(1.0)
 @app.post("/numbers/chart/waterfall")
 async def numbers_chart_wf(property_id: str = Form(...)):
     try:
-        out = numbers_chart_waterfall(property_id)
+        out = await asyncio.to_thread(numbers_chart_waterfall, property_id)
         return JSONResponse(out)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
@@ -1576,7 +1945,7 @@ async def numbers_chart_wf(property_id: str = Form(...)):
 @app.post("/numbers/chart/stack")
 async def numbers_chart_stack(property_id: str = Form(...)):
     try:
-        out = numbers_chart_cost_stack(property_id)
+        out = await asyncio.to_thread(numbers_chart_cost_stack, property_id)
         return JSONResponse(out)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
@@ -1588,7 +1957,7 @@ async def numbers_chart_sens(property_id: str = Form(...), precio_vec_json: str
         import json
         precio_vec = json.loads(precio_vec_json)
         costes_vec = json.loads(costes_vec_json)
-        out = numbers_chart_sensitivity(property_id, precio_vec, costes_vec)
+        out = await asyncio.to_thread(numbers_chart_sensitivity, property_id, precio_vec, costes_vec)
         return JSONResponse(out)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
@@ -3,7 +3,7 @@ import env_loader  # loads .env first
 import base64, os, uuid, re, unicodedata
 import gradio as gr
 
-from agentic import build_graph
+from agentic import get_app
 from tools.property_tools import list_frameworks, list_properties as db_list_properties, add_property as db_add_property
 from tools.property_tools import search_properties as db_search_properties
 from tools.docs_tools import propose_slot, upload_and_link, list_docs, slot_exists
@@ -11,7 +11,7 @@ from tools.registry import transcribe_audio_tool  # decorator tool (Google STT)
 from tools.rag_tool import summarize_document as rag_summarize, qa_document as rag_qa, qa_payment_schedule as rag_qa_pay
 from tools.email_tool import send_email
 
-agent = build_graph()
+agent = get_app()
 
 # simple in-memory UI state
 STATE = {
@@ -0,0 +1,70 @@
+"""Unit-test setup: the `tools.*` modules talk to Supabase/SMTP/OpenAI at import time, so they are
+replaced with in-memory stand-ins before `agentic` / `app` are imported. Run with `pytest tests`."""
+import os
+import sys
+import types
+
+from langchain_core.tools import tool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+CALLS = []
+
+
+@tool("list_docs")
+def list_docs(property_id: str) -> list:
+    """List the document slots of a property."""
+    CALLS.append(("list_docs", property_id))
+    return [{"document_group": "Compra", "document_subgroup": "", "document_name": "Arras"}]
+
+
+@tool("get_numbers")
+def get_numbers(property_id: str) -> list:
+    """Numbers framework of a property."""
+    CALLS.append(("get_numbers", property_id))
+    return [{"item_key": "precio_venta", "amount": 1}]
+
+
+@tool("set_number")
+def set_number(property_id: str, item_key: str, amount: float) -> dict:
+    """Set one number."""
+    CALLS.append(("set_number", property_id))
+    return {"ok": True}
+
+
+@tool("rag_index_document")
+def rag_index_document(property_id: str, document_group: str, document_subgroup: str, document_name: str) -> dict:
+    """Index one document."""
+    CALLS.append(("rag_index_document", document_name))
+    return {"indexed": 1}
+
+
+@tool("rag_index_all_documents")
+def rag_index_all_documents(property_id: str) -> dict:
+    """Index every uploaded document of a property."""
+    CALLS.append(("rag_index_all_documents", property_id))
+    return {"indexed": 3}
+
+
+def _stub_module(name, **attrs):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attrs)
+
+    def _missing(attr):
+        def _unavailable(*args, **kwargs):
+            raise RuntimeError(f"{name}.{attr} is not available in unit tests")
+        return _unavailable
+
+    mod.__getattr__ = _missing
+    sys.modules[name] = mod
+    return mod
+
+
+_stub_module("tools.registry", TOOLS=[list_docs, get_numbers, set_number, rag_index_document, rag_index_all_documents])
+_stub_module("tools.property_tools", list_frameworks=lambda pid: {"documents_schema": f"prop_{pid[:8]}__documents_framework"})
+_stub_module("tools.supabase_client", sb=None, BUCKET="test")
+for _name in ("docs_tools", "rag_tool", "rag_index", "email_tool", "summary_ppt", "numbers_tools", "numbers_agent", "voice_tool"):
+    _stub_module(f"tools.{_name}")
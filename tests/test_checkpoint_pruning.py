@@ -0,0 +1,65 @@
+import sqlite3
+import operator
+from typing import Annotated, List, TypedDict
+
+import pytest
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.graph import END, StateGraph
+
+import agentic
+
+
+class _State(TypedDict):
+    steps: Annotated[List[str], operator.add]
+
+
+def _graph(saver):
+    graph = StateGraph(_State)
+    graph.add_node("a", lambda s: {"steps": ["a"]})
+    graph.add_node("b", lambda s: {"steps": ["b"]})
+    graph.set_entry_point("a")
+    graph.add_edge("a", "b")
+    graph.add_edge("b", END)
+    return graph.compile(checkpointer=saver)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / "checkpoints.db")
+    monkeypatch.setattr(agentic, "_sqlite_path", lambda: path)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    saver = SqliteSaver(conn)
+    app = _graph(saver)
+    for thread in ("t1", "t2"):
+        for _ in range(3):
+            app.invoke({"steps": []}, {"configurable": {"thread_id": thread}})
+    app.invoke({"steps": []}, {"configurable": {"thread_id": "short"}})
+    yield conn, saver
+    conn.close()
+
+
+def _ids(conn, table, thread):
+    return [r[0] for r in conn.execute(
+        f"SELECT DISTINCT checkpoint_id FROM {table} WHERE thread_id = ? ORDER BY checkpoint_id DESC", (thread,))]
+
+
+def test_prune_keeps_the_newest_checkpoints_and_their_writes(db):
+    conn, saver = db
+    before = {t: (_ids(conn, "checkpoints", t), _ids(conn, "writes", t)) for t in ("t1", "t2", "short")}
+    assert len(before["t1"][0]) > 3
+    latest = {t: saver.get_tuple({"configurable": {"thread_id": t}}).checkpoint for t in before}
+
+    agentic.prune_checkpoints(keep=3)
+
+    for thread, (checkpoints, writes) in before.items():
+        kept = checkpoints[:3]
+        assert _ids(conn, "checkpoints", thread) == kept
+        assert _ids(conn, "writes", thread) == [w for w in writes if w >= kept[-1]]
+        assert saver.get_tuple({"configurable": {"thread_id": thread}}).checkpoint == latest[thread]
+
+
+def test_prune_is_a_no_op_when_disabled(db):
+    conn, _ = db
+    total = conn.execute("SELECT count(*) FROM checkpoints").fetchone()
+    agentic.prune_checkpoints(keep=0)
+    assert conn.execute("SELECT count(*) FROM checkpoints").fetchone() == total
@@ -0,0 +1,161 @@
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import agentic
+
+ROWS = '[{"document_name": "Arras"}]'
+
+
+def _call(call_id, name="list_docs", property_id="p1"):
+    return AIMessage(content="", tool_calls=[{"name": name, "args": {"property_id": property_id}, "id": call_id}])
+
+
+def _append_tool_step(state, call_id, content):
+    out = agentic.post_tool(state, [ToolMessage(content=content, name="list_docs", tool_call_id=call_id)], {})
+    state["messages"] = state["messages"] + out["messages"]
+    state["_read_outputs"] = out["_read_outputs"]
+
+
+def _prompt(state):
+    return agentic._assistant_request(state)[1]
+
+
+def test_repeated_read_is_stubbed_without_touching_earlier_messages():
+    state = {"messages": [HumanMessage(content="docs?"), _call("a")]}
+    _append_tool_step(state, "a", ROWS)
+    state["messages"] += [AIMessage(content="Arras."), HumanMessage(content="¿y ahora?"), _call("b")]
+    before = _prompt(state)
+
+    _append_tool_step(state, "b", ROWS)
+    after = _prompt(state)
+
+    assert after[:len(before)] == before
+    assert after[2].content == ROWS
+    assert after[-1].tool_call_id == "b"
+    assert after[-1].content != ROWS and "a" in after[-1].content
+    # State keeps the real output; only the prompt is shortened
+    assert state["messages"][-1].content == ROWS
+
+
+def test_changed_output_is_sent_in_full():
+    state = {"messages": [HumanMessage(content="docs?"), _call("a")]}
+    _append_tool_step(state, "a", ROWS)
+    state["messages"] += [HumanMessage(content="¿y ahora?"), _call("b")]
+    _append_tool_step(state, "b", '[]')
+    assert "prompt_same_as" not in state["messages"][-1].additional_kwargs
+    assert _prompt(state)[-1].content == '[]'
+
+
+def test_outputs_folded_into_the_summary_are_forgotten():
+    state = {"messages": [HumanMessage(content="docs?"), _call("a")]}
+    _append_tool_step(state, "a", ROWS)
+    state["messages"] += [HumanMessage(content="¿y ahora?"), _call("b")]
+    state["summary_upto_idx"] = 3
+    _append_tool_step(state, "b", ROWS)
+    assert "prompt_same_as" not in state["messages"][-1].additional_kwargs
+    assert [v[0] for v in state["_read_outputs"]["seen"].values()] == ["b"]
+
+
+def test_repeat_is_expanded_once_the_original_leaves_the_prompt():
+    state = {"messages": [HumanMessage(content="docs?"), _call("a")]}
+    _append_tool_step(state, "a", ROWS)
+    state["messages"] += [HumanMessage(content="¿y ahora?"), _call("b")]
+    _append_tool_step(state, "b", ROWS)
+    window = agentic._stub_repeated_reads(state["messages"][3:])
+    assert window[-1].content == ROWS
+
+
+def test_prompt_cache_log_reads_streamed_usage(caplog):
+    ai = AIMessage(content="hola", usage_metadata={"input_tokens": 1200, "output_tokens": 3, "total_tokens": 1203})
+    with caplog.at_level("DEBUG", logger=agentic.logger.name):
+        agentic._log_prompt_cache(ai)
+    assert "prompt_tokens=1200" in caplog.text
+
+
+def test_token_memo_is_bounded_and_keyed_by_digest(monkeypatch):
+    monkeypatch.setattr(agentic, "_TOKEN_MEMO_MAX", 2)
+    agentic._token_memo.clear()
+    big = "fila " * 5000
+    n = agentic._count_tokens(big)
+    for text in ("a", "b", "c"):
+        agentic._count_tokens(text)
+    assert len(agentic._token_memo) == 2
+    assert all(isinstance(k, bytes) and len(k) == 16 for k in agentic._token_memo)
+    assert agentic._count_tokens(big) == n
+
+
+def _tokens(monkeypatch):
+    monkeypatch.setattr(agentic, "_message_tokens", lambda m: len(m.content))
+
+
+def test_trim_history_drops_oldest_but_keeps_the_current_turn(monkeypatch):
+    _tokens(monkeypatch)
+    msgs = [HumanMessage(content="a" * 50), AIMessage(content="b" * 50),
+            HumanMessage(content="c" * 10), AIMessage(content="d" * 200)]
+    assert agentic._trim_history(msgs, max_tokens=100) == msgs[2:]
+    assert agentic._trim_history(msgs, max_tokens=1000) is msgs
+
+
+def test_trim_history_never_opens_on_an_orphan_tool_message(monkeypatch):
+    _tokens(monkeypatch)
+    call = _call("a").copy(update={"content": "c" * 20})
+    msgs = [HumanMessage(content="a" * 10), call, ToolMessage(content="x" * 100, name="list_docs", tool_call_id="a"),
+            AIMessage(content="Arras."), HumanMessage(content="y")]
+    trimmed = agentic._trim_history(msgs, max_tokens=120)
+    assert trimmed == msgs[3:]
+
+
+def test_filtered_indices_drop_what_the_summary_covers():
+    messages = [HumanMessage(content=f"u{i}") if i % 2 == 0 else AIMessage(content=f"r{i}") for i in range(30)]
+    state = {"messages": messages, "_filtered_idx": list(range(30)), "_filtered_upto": 30,
+             "summary_upto_idx": 24, "history_summary": "RESUMEN"}
+    assert agentic._filtered_indices(state) == (list(range(24, 30)), 30)
+
+    msgs, sent, updates = agentic._assistant_request(state)
+    assert updates["_filtered_idx"] == list(range(24, 30))
+    assert "RESUMEN" in msgs[1].content
+    assert [m.content for m in sent] == [f"u{i}" if i % 2 == 0 else f"r{i}" for i in range(24, 30)]
+
+
+class _RecordingLLM:
+    def __init__(self):
+        self.seen = []
+
+    def invoke(self, msgs, *args, **kwargs):
+        self.seen.append(msgs)
+        return AIMessage(content="ok")
+
+
+class _Summarizer:
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def invoke(self, msgs):
+        if self.fail:
+            raise RuntimeError("summarizer down")
+        return AIMessage(content="RESUMEN")
+
+
+def _overflowing_turn(monkeypatch, summarizer):
+    monkeypatch.setattr(agentic, "_get_summarizer", lambda: summarizer)
+    llm = _RecordingLLM()
+    monkeypatch.setattr(agentic, "_get_llm", lambda *a, **k: llm)
+    agentic._response_cache.clear()
+    tool_step = [_call("a"), ToolMessage(content=" ".join(f"fila{i}" for i in range(6000)), name="list_docs", tool_call_id="a")]
+    state = {"messages": [HumanMessage(content="hola"), AIMessage(content="hola, ¿qué necesitas?"),
+                          HumanMessage(content="docs?")] + tool_step}
+    return state, llm
+
+
+def test_overflow_is_summarized_before_the_assistant_call(monkeypatch):
+    state, llm = _overflowing_turn(monkeypatch, _Summarizer())
+    out = agentic.assistant(state, {})
+    assert out["history_summary"] == "RESUMEN" and out["summary_upto_idx"] > 0
+    assert "RESUMEN" in llm.seen[0][1].content
+
+
+def test_failed_summary_sends_the_whole_window(monkeypatch):
+    state, llm = _overflowing_turn(monkeypatch, _Summarizer(fail=True))
+    out = agentic.assistant(state, {})
+    assert "summary_upto_idx" not in out
+    sent = [m.content for m in llm.seen[0][1:]]
+    assert sent[:2] == ["hola", "hola, ¿qué necesitas?"]
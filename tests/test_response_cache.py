@@ -0,0 +1,122 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+import agentic
+
+
+class FakeEmbeddings:
+    def embed_query(self, text):
+        # Every text maps to the same direction, so any two queries are "paraphrases"
+        return [1.0, 0.0, 0.0]
+
+
+@pytest.fixture(autouse=True)
+def semantic_cache(monkeypatch):
+    monkeypatch.setattr(agentic, "_SEMANTIC_CACHE_ENABLED", True)
+    monkeypatch.setattr(agentic, "_get_embeddings", lambda: FakeEmbeddings())
+    for cache in (agentic._response_cache, agentic._semantic_cache, agentic._embedding_memo):
+        cache.clear()
+    yield
+
+
+def _ask(state, msgs, thread_id, key="k"):
+    return agentic._response_cache_get(key, state, msgs, thread_id)
+
+
+def test_semantic_hit_is_scoped_to_the_thread():
+    state = {"property_id": "p1"}
+    msgs = [HumanMessage(content="¿qué precio tiene?")]
+    cached, vec = _ask(state, msgs, "t1", key="k1")
+    assert cached is None
+    agentic._response_cache_put("k1", state, msgs, AIMessage(content="200.000 €"), vec, "t1")
+
+    paraphrase = [HumanMessage(content="dime el precio")]
+    hit, _ = _ask(state, paraphrase, "t1", key="k2")
+    assert hit is not None and hit.content == "200.000 €"
+    assert _ask(state, paraphrase, "t2", key="k3")[0] is None
+
+
+def test_semantic_scope_follows_the_summary():
+    state = {"property_id": "p1", "history_summary": "precio 200k", "summary_upto_idx": 1,
+             "messages": [HumanMessage(content="x")]}
+    msgs = [HumanMessage(content="¿qué precio tiene?")]
+    _, vec = _ask(state, msgs, "t1", key="k1")
+    agentic._response_cache_put("k1", state, msgs, AIMessage(content="200.000 €"), vec, "t1")
+    changed = {**state, "history_summary": "precio 250k"}
+    assert _ask(changed, msgs, "t1", key="k2")[0] is None
+
+
+def test_answers_built_on_tool_output_are_not_stored_semantically():
+    state = {"property_id": "p1"}
+    msgs = [
+        HumanMessage(content="números"),
+        AIMessage(content="", tool_calls=[{"name": "get_numbers", "args": {"property_id": "p1"}, "id": "c1"}]),
+        ToolMessage(content='[{"item_key": "precio_venta", "amount": 200000}]', name="get_numbers", tool_call_id="c1"),
+        AIMessage(content="El precio es 200.000 €"),
+        HumanMessage(content="¿qué precio tiene?"),
+    ]
+    _, vec = _ask(state, msgs, "t1", key="k1")
+    agentic._response_cache_put("k1", state, msgs, AIMessage(content="200.000 €"), vec, "t1")
+    assert not any(agentic._semantic_cache.values())
+
+
+def test_exact_key_includes_the_history_summary():
+    msgs = [HumanMessage(content="hola")]
+    base = {"messages": msgs, "summary_upto_idx": 1}
+    key_a = agentic._response_cache_key({**base, "history_summary": "a"}, msgs)
+    key_b = agentic._response_cache_key({**base, "history_summary": "b"}, msgs)
+    assert key_a != key_b
+
+
+def test_exact_key_covers_turns_older_than_the_last_few():
+    tail = [AIMessage(content=f"r{i}") if i % 2 else HumanMessage(content=f"u{i}") for i in range(8)]
+    state = {"messages": []}
+    key_a = agentic._response_cache_key(state, [HumanMessage(content="mi presupuesto es 200k")] + tail)
+    key_b = agentic._response_cache_key(state, [HumanMessage(content="mi presupuesto es 900k")] + tail)
+    assert key_a != key_b
+
+
+def test_write_tools_evict_the_property():
+    p1, p2 = {"property_id": "p1"}, {"property_id": "p2"}
+    msgs = [HumanMessage(content="hola")]
+    for key, state in (("k1", p1), ("k2", p2)):
+        _, vec = _ask(state, msgs, "t1", key=key)
+        agentic._response_cache_put(key, state, msgs, AIMessage(content="hola"), vec, "t1")
+
+    agentic._invalidate_written_properties(p1, [
+        {"name": "get_numbers", "args": {"property_id": "p1"}, "id": "c1"},
+    ])
+    assert _ask(p1, msgs, "t1", key="k1")[0] is not None
+
+    agentic._invalidate_written_properties(p1, [
+        {"name": "set_number", "args": {"property_id": "p1", "item_key": "precio_venta", "amount": 1}, "id": "c2"},
+    ])
+    assert _ask(p1, msgs, "t1", key="k1")[0] is None
+    assert _ask(p2, msgs, "t1", key="k2")[0] is not None
+
+
+@pytest.mark.parametrize("call", [
+    {"name": "list_properties", "args": {"limit": 20}, "id": "c1"},
+    {"name": "get_property", "args": {"property_id": "p1"}, "id": "c2"},
+    {"name": "rag_qa_with_citations", "args": {"property_id": "p1", "query": "precio"}, "id": "c3"},
+    {"name": "add_property", "args": {"name": "Casa", "address": "C"}, "id": "c4"},
+])
+def test_reads_and_unscoped_writes_keep_cached_answers(call):
+    state = {"property_id": "p1"}
+    msgs = [HumanMessage(content="hola")]
+    _, vec = _ask(state, msgs, "t1")
+    agentic._response_cache_put("k", state, msgs, AIMessage(content="hola"), vec, "t1")
+
+    agentic._invalidate_written_properties({}, [call])
+    assert _ask(state, msgs, "t1")[0] is not None
+
+
+def test_purge_all_documents_clears_every_property():
+    msgs = [HumanMessage(content="hola")]
+    for key, state in (("k1", {"property_id": "p1"}), ("k2", {"property_id": "p2"})):
+        _, vec = _ask(state, msgs, "t1", key=key)
+        agentic._response_cache_put(key, state, msgs, AIMessage(content="hola"), vec, "t1")
+
+    agentic._invalidate_written_properties({}, [{"name": "purge_all_documents", "args": {}, "id": "c1"}])
+    assert not agentic._response_cache
+    assert not any(agentic._semantic_cache.values())
@@ -0,0 +1,57 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+import agentic
+
+
+@pytest.mark.parametrize("text", [
+    "sí", "si, adelante", "Confirmo", "confírmalo", "confirmado", "vale", "de acuerdo", "ok",
+    "yes", "go ahead", "please confirm", "Confirmed",
+])
+def test_confirm_replies(text):
+    assert agentic._CONFIRM_RE.search(text)
+
+
+@pytest.mark.parametrize("text", [
+    "no", "cancela", "cancelar", "cancélalo", "Cancelado", "cámbialo", "mejor cambia el nombre", "otro diferente",
+    "nope", "cancel", "cancel it", "change it", "something different",
+])
+def test_cancel_replies(text):
+    assert not agentic._CONFIRM_RE.search(text)
+    assert agentic._CANCEL_RE.search(text)
+
+
+@pytest.mark.parametrize("text", ["I know", "nothing here", "signo", "okupa", "sino"])
+def test_words_containing_keywords_do_not_match(text):
+    assert not agentic._CONFIRM_RE.search(text)
+    assert not agentic._CANCEL_RE.search(text)
+
+
+def _awaiting_state(text):
+    return {
+        "messages": [HumanMessage(content="sube el contrato"), AIMessage(content="¿Lo guardo en Compra / Arras?")],
+        "awaiting_confirmation": True,
+        "proposal": {"document_name": "Arras"},
+        "input": text,
+    }
+
+
+@pytest.mark.parametrize("text", ["cancela", "cancelar", "no, gracias", "cancel"])
+def test_cancel_short_circuits_without_llm(text):
+    state = _awaiting_state(text)
+    updates = agentic.entry_node(state)
+    assert updates["awaiting_confirmation"] is False
+    assert [type(m) for m in updates["messages"]] == [HumanMessage, AIMessage]
+    assert updates["messages"][-1].content == agentic._CANCEL_REPLY
+    merged = {**state, **updates, "messages": state["messages"] + updates["messages"]}
+    assert agentic.after_router(merged) == "end"
+
+
+@pytest.mark.parametrize("text", ["confirmo", "sí, adelante", "yes"])
+def test_confirm_goes_to_assistant(text):
+    state = _awaiting_state(text)
+    updates = agentic.entry_node(state)
+    assert updates["awaiting_confirmation"] is False
+    assert updates["messages"][-1].content == agentic._CONFIRMED_NOTE
+    merged = {**state, **updates, "messages": state["messages"] + updates["messages"]}
+    assert agentic.after_router(merged) == "assistant"
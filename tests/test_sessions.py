@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def sessions_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "SESSIONS_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "_SESSIONS_LOCK_FILE", str(tmp_path / ".lock"))
+    monkeypatch.setattr(app, "SESSIONS", {})
+    monkeypatch.setattr(app, "_UNSAVED", {})
+    monkeypatch.setattr(app, "_FLUSH_DEBOUNCE", 0.01)
+    return tmp_path
+
+
+def _saved(sid):
+    path = app._session_path(sid)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_flush_loop_survives_a_session_that_cannot_be_serialized(monkeypatch):
+    app.SESSIONS["bad"] = {"x": object()}
+    app.SESSIONS["good"] = {"x": 1}
+
+    async def run():
+        monkeypatch.setattr(app, "_dirty_sessions", asyncio.Queue())
+        task = asyncio.create_task(app._flush_sessions_loop())
+        app.save_sessions("bad")
+        app.save_sessions("good")
+        await asyncio.sleep(0.1)
+        assert not task.done()
+        app.SESSIONS["good"]["x"] = 2
+        app.save_sessions("good")
+        await asyncio.sleep(0.1)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(run())
+    assert _saved("bad") is None
+    assert _saved("good") == {"x": 2}
+
+
+def test_asave_sessions_writes_immediately(monkeypatch):
+    app.SESSIONS["s"] = {"x": 1}
+
+    async def run():
+        monkeypatch.setattr(app, "_dirty_sessions", asyncio.Queue())
+        await app.asave_sessions("s")
+
+    asyncio.run(run())
+    assert _saved("s") == {"x": 1}
+
+
+def test_sweep_pending_blobs_removes_only_old_ones(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "_PENDING_DIR", str(tmp_path / "pending"))
+    os.makedirs(app._PENDING_DIR)
+    old, fresh = (os.path.join(app._PENDING_DIR, f"{n}.bin") for n in ("old", "fresh"))
+    for path in (old, fresh):
+        with open(path, "wb") as f:
+            f.write(b"x")
+    stale = os.path.getmtime(old) - 48 * 3600
+    os.utime(old, (stale, stale))
+
+    assert app._sweep_pending_blobs(24) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+
+
+def test_save_without_a_flusher_writes_right_away(monkeypatch):
+    monkeypatch.setattr(app, "_dirty_sessions", None)
+    app.SESSIONS["s"] = {"x": 1}
+    app.save_sessions("s")
+    assert _saved("s") == {"x": 1}
+
+
+def test_auto_save_interval_batches_writes(monkeypatch):
+    monkeypatch.setattr(app, "_dirty_sessions", None)
+    monkeypatch.setattr(app, "_AUTO_SAVE_INTERVAL", 3)
+    app.SESSIONS["s"] = {"x": 0}
+    for i in range(1, 3):
+        app.SESSIONS["s"]["x"] = i
+        app.save_sessions("s")
+    assert _saved("s") is None
+    app.save_sessions("s")
+    assert _saved("s") == {"x": 2}
+    app.SESSIONS["s"]["x"] = 5
+    app.save_sessions("s", force=True)
+    assert _saved("s") == {"x": 5}
+
+
+def test_flush_loop_coalesces_queued_saves(monkeypatch):
+    writes = []
+    monkeypatch.setattr(app, "_write_session", lambda sid, payload: writes.append((sid, json.loads(payload))))
+    app.SESSIONS["s"] = {"x": 0}
+
+    async def run():
+        monkeypatch.setattr(app, "_dirty_sessions", asyncio.Queue())
+        task = asyncio.create_task(app._flush_sessions_loop())
+        for i in range(1, 6):
+            app.SESSIONS["s"]["x"] = i
+            app.save_sessions("s")
+        assert writes == []
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+    asyncio.run(run())
+    assert writes == [("s", {"x": 5})]
+
+
+def test_flush_sessions_writes_batched_and_queued_changes(monkeypatch):
+    monkeypatch.setattr(app, "_AUTO_SAVE_INTERVAL", 10)
+    app.SESSIONS.update({"batched": {"x": 1}, "queued": {"x": 2}})
+
+    async def run():
+        monkeypatch.setattr(app, "_dirty_sessions", asyncio.Queue())
+        app.save_sessions("batched")
+        app._dirty_sessions.put_nowait("queued")
+        app.flush_sessions()
+
+    asyncio.run(run())
+    assert _saved("batched") == {"x": 1}
+    assert _saved("queued") == {"x": 2}
+
+
+def test_unserializable_session_never_raises_into_the_caller(monkeypatch):
+    monkeypatch.setattr(app, "_dirty_sessions", None)
+    app.SESSIONS.update({"bad": {"x": object()}, "good": {"x": 1}})
+    app.save_sessions("bad", force=True)
+    asyncio.run(app.asave_sessions("bad"))
+
+    app.save_sessions("bad")
+    app._UNSAVED.update({"bad": 1, "good": 1})
+    app.flush_sessions()
+    assert _saved("bad") is None
+    assert _saved("good") == {"x": 1}
+
+
+def test_streamed_answer_becomes_the_last_assistant_response(monkeypatch):
+    from types import SimpleNamespace
+    from langchain_core.messages import AIMessage
+
+    class FakeAgent:
+        async def astream(self, state, config=None, stream_mode=None):
+            yield AIMessage(content="Tienes Arras."), {"langgraph_node": "assistant"}
+
+        async def aget_state(self, config):
+            return SimpleNamespace(values={"messages": [AIMessage(content="Tienes Arras.")]})
+
+    async def fake_app():
+        return FakeAgent()
+
+    monkeypatch.setattr(app, "aget_app", fake_app)
+    monkeypatch.setattr(app, "_dirty_sessions", None)
+
+    async def run():
+        return [event async for event in app.stream_turn("s", "docs?")]
+
+    events = asyncio.run(run())
+    assert '"done": true' in events[-1]
+    assert app.SESSIONS["s"]["last_assistant_response"] == "Tienes Arras."
+    assert _saved("s")["last_assistant_response"] == "Tienes Arras."
@@ -0,0 +1,88 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+import agentic
+from conftest import CALLS
+
+
+@pytest.fixture(autouse=True)
+def calls():
+    CALLS.clear()
+    yield CALLS
+
+
+def _call(name, call_id, **args):
+    return {"name": name, "args": args, "id": call_id, "type": "tool_call"}
+
+
+def _state(*calls, tool_cache=None):
+    return {"messages": [HumanMessage(content="x"), AIMessage(content="", tool_calls=list(calls))],
+            "tool_cache": tool_cache or {}, "property_id": "p1"}
+
+
+def _index(call_id, name):
+    return _call("rag_index_document", call_id, property_id="p1", document_group="Compra",
+                 document_subgroup="", document_name=name)
+
+
+def test_coalesced_index_calls_keep_their_own_tool_name(calls):
+    out = agentic.tools_node(_state(_index("a", "Arras"), _index("b", "Escritura"), _index("c", "Nota")), {"configurable": {}})
+    assert calls == [("rag_index_all_documents", "p1")]
+    assert [(m.tool_call_id, m.name) for m in out["messages"]] == [
+        ("a", "rag_index_document"), ("b", "rag_index_document"), ("c", "rag_index_document")]
+
+
+def _run(state):
+    return agentic.tools_node(state, {"configurable": {}})
+
+
+def test_read_only_repeat_is_served_from_the_tool_cache(calls):
+    first = _run(_state(_call("list_docs", "a", property_id="p1")))
+    assert calls == [("list_docs", "p1")]
+
+    again = _run(_state(_call("list_docs", "b", property_id="p1"), tool_cache=first["tool_cache"]))
+    assert calls == [("list_docs", "p1")]
+    assert again["messages"][0].tool_call_id == "b"
+    assert again["messages"][0].content == first["messages"][0].content
+
+
+def test_identical_calls_in_one_message_run_once(calls):
+    out = _run(_state(_call("get_numbers", "a", property_id="p1"), _call("get_numbers", "b", property_id="p1")))
+    assert calls == [("get_numbers", "p1")]
+    assert [m.tool_call_id for m in out["messages"]] == ["a", "b"]
+
+
+def test_write_tool_clears_the_tool_cache(calls):
+    cache = _run(_state(_call("list_docs", "a", property_id="p1")))["tool_cache"]
+    out = _run(_state(_call("set_number", "b", property_id="p1", item_key="precio_venta", amount=1.0), tool_cache=cache))
+    assert out["tool_cache"] == {}
+
+    _run(_state(_call("list_docs", "c", property_id="p1"), tool_cache=out["tool_cache"]))
+    assert calls == [("list_docs", "p1"), ("set_number", "p1"), ("list_docs", "p1")]
+
+
+def test_expired_entries_are_not_served(calls, monkeypatch):
+    cache = _run(_state(_call("list_docs", "a", property_id="p1")))["tool_cache"]
+    monkeypatch.setattr(agentic, "_TOOL_CACHE_TTL", 0)
+    _, live, results, misses, _ = agentic._split_tool_calls(_state(_call("list_docs", "b", property_id="p1"), tool_cache=cache))
+    assert live == {} and results == {}
+    assert [tc["id"] for tc in misses] == ["b"]
+
+
+def test_new_user_turn_starts_with_an_empty_tool_cache():
+    cache = {"k": {"ts": 0, "content": "[]"}}
+    out = agentic.entry_node({"input": "hola", "messages": [], "tool_cache": cache})
+    assert out["tool_cache"] == {}
+
+
+def test_only_write_tools_clear_the_tool_cache():
+    from langchain_core.messages import ToolMessage
+
+    cache = {"k": {"ts": 9e12, "content": "[]"}}
+    lookup = _call("get_property", "a", property_id="p1")
+    out = [ToolMessage(content="{}", name="get_property", tool_call_id="a")]
+    assert "k" in agentic._record_tool_results([lookup], dict(cache), [lookup], out, {}, {})
+
+    write = _call("upsert_summary_value", "b", property_id="p1", item_key="roi", amount=1.0, provenance={})
+    out = [ToolMessage(content="{}", name="upsert_summary_value", tool_call_id="b")]
+    assert agentic._record_tool_results([write], dict(cache), [write], out, {}, {}) == {}
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import io, math, re, requests
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Tuple
 
 from .supabase_client import sb
@@ -213,6 +214,9 @@ def qa_with_citations(property_id: str, query: str, top_k: int = 5, model: str |
     return {"answer": answer, "citations": citations}
 
 
+_INDEX_CONCURRENCY = 4
+
+
 def index_all_documents(property_id: str) -> Dict[str, Any]:
     """Index all documents with storage_key for a property.
     Returns {indexed, details: [{doc, indexed, error?}]} for diagnóstico.
@@ -222,11 +226,19 @@ def index_all_documents(property_id: str) -> Dict[str, Any]:
         rows = list_docs(property_id)
     except Exception as e:
         return {"indexed": 0, "error": str(e), "details": []}
+    # Each document is download + extract + one embeddings call + upsert, all I/O bound:
+    # index them concurrently instead of one after another
+    uploaded = [r for r in rows if r.get("storage_key")]
+    with ThreadPoolExecutor(max_workers=max(1, min(_INDEX_CONCURRENCY, len(uploaded)))) as pool:
+        results = iter(list(pool.map(
+            lambda r: index_document(property_id, r["document_group"], r.get("document_subgroup", ""), r["document_name"]),
+            uploaded,
+        )))
     count = 0
     details: List[Dict[str, Any]] = []
     for r in rows:
         if r.get("storage_key"):
-            out = index_document(property_id, r["document_group"], r.get("document_subgroup", ""), r["document_name"])
+            out = next(results)
             count += int(out.get("indexed", 0) or 0)
             details.append({
                 "doc": f"{r['document_group']} / {r.get('document_subgroup','')} / {r['document_name']}",